@@ -6,6 +6,28 @@ export MQTT_BROKER=$(bashio::config 'mqtt_broker')
 export MQTT_PORT=$(bashio::config 'mqtt_port')
 export MQTT_USERNAME=$(bashio::config 'mqtt_username')
 export MQTT_PASSWORD=$(bashio::config 'mqtt_password')
+export MQTT_HEARTBEAT=$(bashio::config 'mqtt_heartbeat')
+export MQTT_AGGREGATE=$(bashio::config 'mqtt_aggregate')
+export MQTT_OUTBOX_PATH=$(bashio::config 'mqtt_outbox')
+# Set polling environment variables
+export POLL_INTERVAL=$(bashio::config 'poll_interval')
+export FAST_POLL_INTERVAL=$(bashio::config 'fast_poll_interval')
+export SLOW_POLL_INTERVAL=$(bashio::config 'slow_poll_interval')
+export POLL_WORKERS=$(bashio::config 'poll_workers')
+# Set HTTP server environment variables
+export SERVER_MODE=$(bashio::config 'server_mode')
+export HTTP_THREADS=$(bashio::config 'http_threads')
+export STREAM_MAX_CLIENTS=$(bashio::config 'stream_max_clients')
+export HISTORY_DB=$(bashio::config 'history_db')
+export DERIVED_STATE=$(bashio::config 'derived_state')
+export CONFIG_WATCH_INTERVAL=$(bashio::config 'config_watch_interval')
+# Set device scan environment variables
+export SCAN_UNIT_IDS=$(bashio::config 'scan_unit_ids')
+export SCAN_CACHE=$(bashio::config 'scan_cache')
+export SCAN_TTL=$(bashio::config 'scan_ttl')
+# Set cluster environment variables
+export CLUSTER_NODE_ID=$(bashio::config 'cluster_node_id')
+export CLUSTER_URL=$(bashio::config 'cluster_url')
 
 # Try UI config
 if bashio::config.exists 'config'; then
@@ -31,6 +53,21 @@ mv /app/config_processed.json /app/config.json
 echo "Final /app/config.json content:"
 cat /app/config.json 2>/app/config_final.log || echo "Error reading final config.json"
 cat /app/config_final.log
+# The running add-on reads a copy in /share that can be edited and reloaded without a
+# restart; the copy is replaced from the 'config' option only when that option changes
+export CONFIG_PATH=$(bashio::config 'config_path')
+mkdir -p "$(dirname "$CONFIG_PATH")"
+if [ ! -f "$CONFIG_PATH" ] || ! cmp -s /app/config.json /data/config_option.json; then
+    echo "Writing $CONFIG_PATH from the config option"
+    cp /app/config.json "$CONFIG_PATH"
+    cp /app/config.json /data/config_option.json
+fi
+# Derived metrics are a JSON list in the 'derived' option
+if bashio::config.has_value 'derived'; then
+    bashio::config 'derived' > /app/derived.json
+else
+    echo '[]' > /app/derived.json
+fi
 echo "Starting NGINX"
 nginx || echo "Error starting NGINX"
 echo "Starting Flask app"
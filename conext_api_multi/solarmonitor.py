@@ -1,12 +1,40 @@
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, redirect, request
 from flask_restful import Api, Resource
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from pyModbusTCP.client import ModbusClient
+from pyModbusTCP.constants import MB_NO_ERR, MB_EXCEPT_ERR, MB_TIMEOUT_ERR
 import paho.mqtt.client as mqtt
-from time import sleep
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heappush, heappop
+from itertools import count, islice
+from contextlib import contextmanager
+from time import sleep, monotonic, time
+from email.utils import formatdate
+from urllib.parse import quote, urlencode
+from urllib.request import Request, urlopen
+import bisect
+from datetime import datetime
+import ast
+from array import array
+from collections import deque
+import gzip
+import hashlib
 import json
+import math
 import os
+import queue
+import re
+import sqlite3
+import struct
 import logging
 import threading
+import uuid
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 app = Flask(__name__)
 api = Api(app)
@@ -21,94 +49,431 @@ MQTT_PORT = int(os.getenv('MQTT_PORT', 1883))
 MQTT_USERNAME = os.getenv('MQTT_USERNAME', '')
 MQTT_PASSWORD = os.getenv('MQTT_PASSWORD', '')
 MQTT_DISCOVERY_PREFIX = 'homeassistant'
+# Unchanged values are republished at least this often (seconds)
+MQTT_HEARTBEAT = float(os.getenv('MQTT_HEARTBEAT', 300))
+# Publish one JSON document per device instead of one message per register
+MQTT_AGGREGATE = os.getenv('MQTT_AGGREGATE', 'false').lower() == 'true'
+# Messages published while the broker is unreachable are queued in memory and
+# spilled to MQTT_OUTBOX_PATH (optional SQLite file), dropping the oldest when full
+MQTT_OUTBOX_PATH = os.getenv('MQTT_OUTBOX_PATH', '')
+MQTT_OUTBOX_MEMORY = int(os.getenv('MQTT_OUTBOX_MEMORY', 1000))
+MQTT_OUTBOX_DISK = int(os.getenv('MQTT_OUTBOX_DISK', 100000))
+MQTT_REPLAY_BATCH = int(os.getenv('MQTT_REPLAY_BATCH', 100))
+MQTT_REPLAY_RATE = float(os.getenv('MQTT_REPLAY_RATE', 200))  # messages per second
+
+# Gateway config file; it is checked for changes every CONFIG_WATCH_INTERVAL seconds (0 disables).
+# The add-on keeps it in the mapped /share folder so it can be edited while running
+CONFIG_PATH = os.getenv('CONFIG_PATH', '/share/conext_api_multi/config.json')
+CONFIG_WATCH_INTERVAL = float(os.getenv('CONFIG_WATCH_INTERVAL', 5))
+
+# Device scan configuration; gateways with "scan": true get their device lists from a
+# unit-ID scan, cached in SCAN_CACHE (optional JSON file) for SCAN_TTL seconds
+SCAN_UNIT_IDS = os.getenv('SCAN_UNIT_IDS', '1-247')
+SCAN_WORKERS = int(os.getenv('SCAN_WORKERS', 8))
+SCAN_TIMEOUT = float(os.getenv('SCAN_TIMEOUT', 1))
+SCAN_CACHE = os.getenv('SCAN_CACHE', '')
+SCAN_TTL = float(os.getenv('SCAN_TTL', 86400))
+
+# Derived metrics are declared in DERIVED_PATH (a JSON list); integrator totals are kept
+# across restarts in DERIVED_STATE (optional JSON file)
+DERIVED_PATH = os.getenv('DERIVED_PATH', '/app/derived.json')
+DERIVED_STATE = os.getenv('DERIVED_STATE', '')
+
+# Polling configuration
+POLL_INTERVAL = float(os.getenv('POLL_INTERVAL', 10))
+FAST_POLL_INTERVAL = float(os.getenv('FAST_POLL_INTERVAL', 2))
+SLOW_POLL_INTERVAL = float(os.getenv('SLOW_POLL_INTERVAL', 300))
+POLL_WORKERS = int(os.getenv('POLL_WORKERS', 4))
+
+# History configuration; HISTORY_DB is an optional SQLite file that keeps rollups across restarts
+HISTORY_RAW_SAMPLES = int(os.getenv('HISTORY_RAW_SAMPLES', 720))
+HISTORY_DB = os.getenv('HISTORY_DB', '')
+
+# HTTP server configuration
+SERVER_MODE = os.getenv('SERVER_MODE', 'production')
+HTTP_PORT = int(os.getenv('HTTP_PORT', 5000))
+HTTP_THREADS = int(os.getenv('HTTP_THREADS', 8))
+
+# Cluster mode: instances sharing one config and broker split the gateways between them.
+# CLUSTER_NODE_ID (empty disables) must be unique per instance and CLUSTER_URL is where
+# other instances and redirected clients reach this one's API
+CLUSTER_NODE_ID = os.getenv('CLUSTER_NODE_ID', '')
+CLUSTER_URL = os.getenv('CLUSTER_URL', '').rstrip('/')
+CLUSTER_HEARTBEAT = float(os.getenv('CLUSTER_HEARTBEAT', 5))
+CLUSTER_LEASE = float(os.getenv('CLUSTER_LEASE', 15))
+CLUSTER_TOPIC = 'conext/cluster/nodes/'
+CLUSTER_PROXY_TIMEOUT = 10
+
+# Live stream configuration; each /stream client holds an HTTP thread, so at most
+# STREAM_MAX_CLIENTS are accepted, and a client more than STREAM_BUFFER updates behind is dropped
+STREAM_MAX_CLIENTS = int(os.getenv('STREAM_MAX_CLIENTS', 32))
+STREAM_BUFFER = int(os.getenv('STREAM_BUFFER', 256))
+STREAM_KEEPALIVE = float(os.getenv('STREAM_KEEPALIVE', 15))
+
+# Seconds a normal tier value may be served from the snapshot before a live read is
+# needed; other tiers scale with their interval
+SNAPSHOT_MAX_AGE = float(os.getenv('SNAPSHOT_MAX_AGE', POLL_INTERVAL * 3))
+
+# Prometheus metrics
+modbus_read_seconds = Histogram('conext_modbus_read_seconds', 'Modbus block read latency', ['gateway', 'device_type'])
+modbus_connect_seconds = Histogram('conext_modbus_connect_seconds', 'Modbus TCP connect latency', ['gateway'])
+modbus_read_errors = Counter('conext_modbus_read_errors_total', 'Modbus read errors by type', ['gateway', 'device_type', 'type'])
+poll_run_seconds = Histogram('conext_poll_run_seconds', 'Duration of a gateway poll run', ['gateway'], buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60))
+poll_lag_seconds = Histogram('conext_poll_schedule_lag_seconds', 'Delay between a poll coming due and starting', ['gateway'], buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30))
+mqtt_messages = Counter('conext_mqtt_messages_total', 'MQTT messages by result (published, suppressed, queued, replayed, dropped)', ['result'])
+breaker_trips = Counter('conext_breaker_trips_total', 'Circuit breaker trips', ['breaker'])
+stream_dropped = Counter('conext_stream_dropped_total', 'Stream clients disconnected for falling behind')
+control_commands = Counter('conext_commands_total', 'Control writes by result (done, failed, superseded)', ['result'])
+rest_cache_requests = Counter('conext_rest_cache_requests_total', 'REST reads by snapshot result (hit, miss, bypass)', ['device_type', 'result'])
 
 # MQTT client with MQTTv5
 mqtt_client = mqtt.Client(protocol=mqtt.MQTTv5)
 if MQTT_USERNAME and MQTT_PASSWORD:
     mqtt_client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
 
+class PublishFilter:
+    """Suppresses publishes of values that have not changed since they were last sent.
+
+    Numbers count as changed once they move by more than the larger of the
+    absolute deadband and deadband_pct percent of the last published value.
+    Every topic is republished at least once per heartbeat seconds.
+    """
+    def __init__(self, heartbeat=MQTT_HEARTBEAT):
+        self.heartbeat = heartbeat
+        self.sent = 0
+        self.suppressed = 0
+        self._lock = threading.Lock()
+        self._last = {}  # topic -> (value, published at)
+
+    @staticmethod
+    def _changed(value, last_value, deadband, deadband_pct):
+        numeric = all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in (value, last_value))
+        if not numeric:
+            return value != last_value
+        threshold = max(deadband, abs(last_value) * deadband_pct / 100)
+        if threshold > 0:
+            return abs(value - last_value) >= threshold
+        return value != last_value
+
+    def check(self, topic, value, deadband=0, deadband_pct=0):
+        now = monotonic()
+        with self._lock:
+            last = self._last.get(topic)
+            if last is not None and now - last[1] < self.heartbeat and not self._changed(value, last[0], deadband, deadband_pct):
+                return False
+            self._last[topic] = (value, now)
+            return True
+
+    def count(self, sent):
+        with self._lock:
+            if sent:
+                self.sent += 1
+            else:
+                self.suppressed += 1
+        if not sent:
+            mqtt_messages.labels('suppressed').inc()
+
+    def should_publish(self, topic, value, deadband=0, deadband_pct=0):
+        publish = self.check(topic, value, deadband, deadband_pct)
+        self.count(publish)
+        return publish
+
+    def reset(self):
+        with self._lock:
+            self._last.clear()
+
+    def stats(self):
+        return {'sent': self.sent, 'suppressed': self.suppressed}
+
+publish_filter = PublishFilter()
+
+class MqttOutbox:
+    """Bounded FIFO of (topic, payload, retain) messages waiting for the broker.
+
+    New messages are held in memory; once memory_limit is exceeded, or when
+    spill() is called, they move to an SQLite file so they survive restarts.
+    The disk queue keeps at most disk_limit messages. Without a db_path the
+    memory queue simply drops its oldest messages when full.
+    """
+    def __init__(self, db_path='', memory_limit=1000, disk_limit=100000):
+        self.db_path = db_path
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._memory = deque()  # (seq, topic, payload, retain)
+        self._seq = count()
+        self._disk_count = 0
+        self._db = None
+        self.ready = threading.Event()
+        if db_path:
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute('CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT, payload TEXT, retain INTEGER)')
+                self._disk_count = self._db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+                if self._disk_count:
+                    logger.info(f"{self._disk_count} queued MQTT messages found in {db_path}")
+                    self.ready.set()
+            except sqlite3.Error as e:
+                logger.error(f"Failed to open MQTT outbox {db_path}; queueing in memory only: {str(e)}")
+                self._db = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._memory) + self._disk_count
+
+    def put(self, topic, payload, retain=False):
+        with self._lock:
+            self._memory.append((next(self._seq), topic, payload, retain))
+            if len(self._memory) > self.memory_limit:
+                if self._db is not None:
+                    self._spill()
+                else:
+                    self._memory.popleft()
+                    self.dropped += 1
+                    mqtt_messages.labels('dropped').inc()
+        self.ready.set()
+
+    def spill(self):
+        with self._lock:
+            if self._db is not None and self._memory:
+                self._spill()
+
+    def _spill(self):
+        rows = [(topic, payload, int(retain)) for _, topic, payload, retain in self._memory]
+        try:
+            with self._db:
+                self._db.executemany('INSERT INTO outbox (topic, payload, retain) VALUES (?, ?, ?)', rows)
+                self._disk_count += len(rows)
+                overflow = self._disk_count - self.disk_limit
+                if overflow > 0:
+                    self._db.execute('DELETE FROM outbox WHERE id IN (SELECT id FROM outbox ORDER BY id LIMIT ?)', (overflow,))
+                    self._disk_count -= overflow
+                    self.dropped += overflow
+                    mqtt_messages.labels('dropped').inc(overflow)
+            self._memory.clear()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to spill MQTT outbox to {self.db_path}: {str(e)}")
+
+    def peek(self, limit):
+        """Return up to limit of the oldest messages as [(key, topic, payload, retain)] without removing them."""
+        with self._lock:
+            if self._disk_count:
+                rows = self._db.execute('SELECT id, topic, payload, retain FROM outbox ORDER BY id LIMIT ?', (limit,)).fetchall()
+                return [(('disk', row_id), topic, payload, bool(retain)) for row_id, topic, payload, retain in rows]
+            return [(('memory', seq), topic, payload, retain) for seq, topic, payload, retain in islice(self._memory, limit)]
+
+    def remove(self, batch):
+        # Messages are removed by id: between peek() and remove() memory may have been
+        # spilled to disk or had its oldest messages dropped. Spilled ones are sent again
+        with self._lock:
+            disk_ids = [(key[1],) for key, _, _, _ in batch if key[0] == 'disk']
+            if disk_ids:
+                with self._db:
+                    removed = self._db.executemany('DELETE FROM outbox WHERE id = ?', disk_ids).rowcount
+                self._disk_count -= removed
+            memory_ids = {key[1] for key, _, _, _ in batch if key[0] == 'memory'}
+            if memory_ids:
+                self._memory = deque(message for message in self._memory if message[0] not in memory_ids)
+            if not self._memory and not self._disk_count:
+                self.ready.clear()
+
+mqtt_outbox = MqttOutbox(MQTT_OUTBOX_PATH, MQTT_OUTBOX_MEMORY, MQTT_OUTBOX_DISK)
+
+def mqtt_publish(topic, payload, retain=False):
+    # Queue behind any backlog so messages reach the broker in order
+    if mqtt_client.is_connected() and not len(mqtt_outbox):
+        result = mqtt_client.publish(topic, payload, retain=retain)
+        if result.rc == mqtt.MQTT_ERR_SUCCESS:
+            mqtt_messages.labels('published').inc()
+            return
+    mqtt_outbox.put(topic, payload, retain)
+    mqtt_messages.labels('queued').inc()
+
+# Background thread to replay queued messages once the broker is back
+def replay_mqtt_outbox():
+    while True:
+        mqtt_outbox.ready.wait(5)
+        if not mqtt_client.is_connected():
+            # Persist the backlog so a restart during the outage does not lose it
+            mqtt_outbox.spill()
+            sleep(1)
+            continue
+        # One bad batch must not end the thread, or every later message would queue forever
+        try:
+            batch = mqtt_outbox.peek(MQTT_REPLAY_BATCH)
+            if not batch:
+                continue
+            sent = []
+            for message in batch:
+                _, topic, payload, retain = message
+                if mqtt_client.publish(topic, payload, qos=1, retain=retain).rc != mqtt.MQTT_ERR_SUCCESS:
+                    break
+                sent.append(message)
+            mqtt_outbox.remove(sent)
+        except Exception as e:
+            logger.error(f"Error replaying queued MQTT messages: {str(e)}")
+            sleep(1)
+            continue
+        mqtt_messages.labels('replayed').inc(len(sent))
+        if len(sent) < len(batch):
+            sleep(1)
+        else:
+            sleep(len(sent) / MQTT_REPLAY_RATE)
+
 def on_connect(client, userdata, flags, rc, properties=None):
     if rc == 0:
         logger.info("Connected to MQTT broker")
+        # The broker may have restarted, so send every value again
+        publish_filter.reset()
+        if len(mqtt_outbox):
+            logger.info(f"Replaying {len(mqtt_outbox)} queued MQTT messages")
+            mqtt_outbox.ready.set()
+        if cluster is not None:
+            client.subscribe(f"{CLUSTER_TOPIC}+")
+            cluster.announce()
     else:
         logger.error(f"Failed to connect to MQTT broker, return code {rc}")
 
+def on_disconnect(client, userdata, rc, properties=None):
+    if rc != 0:
+        logger.warning(f"Disconnected from MQTT broker (return code {rc}); queueing messages until reconnected")
+
+def on_message(client, userdata, message):
+    if cluster is not None and message.topic.startswith(CLUSTER_TOPIC):
+        cluster.on_heartbeat(message.topic[len(CLUSTER_TOPIC):], message.payload)
+
 mqtt_client.on_connect = on_connect
+mqtt_client.on_disconnect = on_disconnect
+mqtt_client.on_message = on_message
 
-# Reconnect logic
+# Reconnect logic; once connected, paho's loop reconnects with the same backoff
 def connect_mqtt():
-    try:
-        mqtt_client.connect(MQTT_BROKER, MQTT_PORT)
-        mqtt_client.loop_start()
-    except Exception as e:
-        logger.error(f"Failed to connect to MQTT broker: {str(e)}")
-        sleep(5)
-        connect_mqtt()
+    delay = 1
+    while True:
+        try:
+            mqtt_client.connect(MQTT_BROKER, MQTT_PORT)
+            break
+        except Exception as e:
+            logger.error(f"Failed to connect to MQTT broker: {str(e)}; retrying in {delay}s")
+            sleep(delay)
+            delay = min(delay * 2, 60)
+    mqtt_client.reconnect_delay_set(min_delay=1, max_delay=60)
+    mqtt_client.loop_start()
 
-threading.Thread(target=connect_mqtt, daemon=True).start()
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
 
-# Hardcoded global configs
-registers_data = {
-    'battery': {
-        'voltage': '70,2,1000',  # uint32 /1000 = V
-        'temperature': '74,1,-273',  # *0.01 + extra (C)
-        'soc': '76,1,1',  # %
-        'soh': '88,1,1'   # %
-    },
-    'powermeter': {
-        'power': '1251,2,0.1',  # int32, scale 0.1, W
-        'voltage': '1271,1,0.1',  # uint16, scale 0.1, V
-        'current': '1281,2,0.1',  # int32, scale 0.1, A
-        'energy': '1301,4,0.001'  # int64, scale 0.001, kWh
-    },
-    'inverter': {
-        'state': '64,1,0',
-        'enabled': '66,1,0',
-        'faults': '68,1,0',
-        'warnings': '69,1,0',
-        'status': '122,1,0',
-        'load': '120,1,0',
-        'ac_in_volts': '126,1,10',
-        'ac_in_freq': '130,1,10',
-        'ac_out_volts': '142,1,10',
-        'ac_out_freq': '146,1,10',
-        'battery_volts': '154,1,10',
-    },
-    'cc': {
-        'state': '64,1,0',
-        'faults': '68,1,0',
-        'warnings': '69,1,0',
-        'status': '73,1,0',
-        'pv_volts': '76,1,10',
-        'pv_amps': '78,1,10',
-        'battery_volts': '80,1,10',
-        'output_power': '88,1,10',
-        'daily_kwh': '90,1,10',
-        'aux_status': '92,1,0',
-        'association': '249,1,0'
-    },
-    'ags': {
-        'state': '64,1,0',
-        'faults': '68,1,0',
-        'warnings': '69,1,0',
-        'gen_state': '70,1,0',
-        'start_mode': '72,1,0'
-    },
-    'scp': {
-        'state': '64,1,0',
-        'faults': '68,1,0',
-        'warnings': '69,1,0',
-        'display_status': '70,1,0'
-    },
-    'gridtie': {
-        'state': '64,1,0',
-        'faults': '68,1,0',
-        'warnings': '69,1,0',
-        'pv_volts': '76,1,10',
-        'pv_power': '88,1,10'
-    }
-}
+class HashRing:
+    """Consistent hash ring; each node gets replicas points so gateways spread evenly
+    and only a departed node's gateways move when membership changes."""
+    def __init__(self, nodes, replicas=64):
+        self._points = sorted((ring_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self._hashes = [point for point, _ in self._points]
+
+    def owner(self, key):
+        if not self._points:
+            return None
+        return self._points[bisect.bisect(self._hashes, ring_hash(key)) % len(self._points)][1]
+
+class Cluster:
+    """Tracks the instances sharing this config and which gateways each one polls.
+
+    Every node keeps a retained heartbeat on conext/cluster/nodes/<node>. Its MQTT
+    last will clears the heartbeat if the node drops off the broker. A node whose
+    heartbeat is older than lease seconds counts as dead either way. Gateways
+    are assigned to the live nodes on a hash ring, so a dead node's gateways move
+    to the survivors and the rest stay where they are.
+    """
+    def __init__(self, node_id, url, heartbeat=CLUSTER_HEARTBEAT, lease=CLUSTER_LEASE):
+        self.node_id = node_id
+        self.url = url
+        self.heartbeat = heartbeat
+        self.lease = lease
+        self.settled = threading.Event()
+        self._lock = threading.Lock()
+        self._nodes = {}  # node -> {'url', 'time'} from its last heartbeat
+        self._members = (node_id,)
+        self._ring = HashRing(self._members)
+
+    @property
+    def topic(self):
+        return f"{CLUSTER_TOPIC}{self.node_id}"
+
+    def announce(self):
+        payload = {'node': self.node_id, 'url': self.url, 'time': time(), 'lease': self.lease}
+        mqtt_client.publish(self.topic, json.dumps(payload), qos=1, retain=True)
+
+    def on_heartbeat(self, node, payload):
+        if node == self.node_id:
+            return
+        with self._lock:
+            if not payload:
+                self._nodes.pop(node, None)
+            else:
+                try:
+                    heartbeat = json.loads(payload)
+                    self._nodes[node] = {'url': heartbeat.get('url', ''), 'time': float(heartbeat['time'])}
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.warning(f"Ignoring malformed heartbeat from {node}: {str(e)}")
+        self.refresh()
+
+    def refresh(self):
+        # Heartbeat times come from the sending node, so clocks are assumed to be in sync
+        now = time()
+        with self._lock:
+            members = tuple(sorted({self.node_id} | {
+                node for node, info in self._nodes.items() if now - info['time'] <= self.lease
+            }))
+            if members == self._members:
+                return
+            self._members = members
+            self._ring = HashRing(members)
+        logger.info(f"Cluster members are now {list(members)}; polling {[g for g in gateways if self.owns(g)]}")
+
+    def owner(self, gateway):
+        with self._lock:
+            return self._ring.owner(gateway)
+
+    def owns(self, gateway):
+        return self.owner(gateway) == self.node_id
+
+    def url_of(self, node):
+        if node == self.node_id:
+            return self.url
+        with self._lock:
+            return self._nodes.get(node, {}).get('url', '')
+
+    def status(self):
+        with self._lock:
+            members = list(self._members)
+            nodes = {node: dict(info) for node, info in self._nodes.items()}
+        nodes[self.node_id] = {'url': self.url, 'time': time()}
+        return {
+            'node': self.node_id,
+            'members': members,
+            'nodes': nodes,
+            'gateways': {gateway: self.owner(gateway) for gateway in gateways}
+        }
+
+cluster = Cluster(CLUSTER_NODE_ID, CLUSTER_URL) if CLUSTER_NODE_ID else None
+if cluster is not None:
+    # The broker clears our heartbeat if we drop off without saying goodbye
+    mqtt_client.will_set(cluster.topic, '', qos=1, retain=True)
 
+# Background thread to renew this node's heartbeat and expire silent nodes
+def cluster_heartbeat():
+    while True:
+        if mqtt_client.is_connected():
+            cluster.announce()
+            if not cluster.settled.is_set():
+                # Give the other nodes' retained heartbeats a moment to arrive before polling
+                sleep(cluster.heartbeat)
+                cluster.settled.set()
+        cluster.refresh()
+        sleep(cluster.heartbeat)
+
+# Hardcoded global configs
 operating_state = {
     0: 'Invert',
     1: 'Grid Support',
@@ -147,355 +512,2211 @@ scp_status = {
     1: 'Active'
 }
 
+force_charger_state = {
+    1: 'Bulk',
+    2: 'Float',
+    3: 'No Float'
+}
+
+generator_mode = {
+    0: 'Stop',
+    1: 'Start',
+    2: 'Automatic'
+}
+
 gridtie_status = {
     0: 'Idle',
     1: 'Producing'
 }
 
+cc_faults = {1: 'Has Active Faults'}
+cc_warnings = {1: 'Has Active Warnings'}
+
+# Register map per device type. Each register has an address and a length in
+# words, and optionally: signed, scale, offset, type ('string' for ASCII blocks),
+# enum (with enum_default for unmapped values), unit, device_class, state_class,
+# tier (fast, normal (default), slow or seconds between polls) and deadband /
+# deadband_pct (smallest absolute / percent change that is published to MQTT).
+# Registers marked writable can be set through PUT, within min / max if given
+registers_data = {
+    'battery': {
+        'voltage': {'register': 70, 'length': 2, 'scale': 0.001, 'unit': 'V', 'device_class': 'voltage'},
+        'temperature': {'register': 74, 'length': 1, 'scale': 0.01, 'offset': -273, 'unit': '°C', 'device_class': 'temperature', 'deadband': 0.5},
+        'soc': {'register': 76, 'length': 1, 'unit': '%', 'device_class': 'battery'},
+        'soh': {'register': 88, 'length': 1, 'unit': '%', 'tier': 'slow'}
+    },
+    'powermeter': {
+        'power': {'register': 1251, 'length': 2, 'signed': True, 'scale': 0.1, 'unit': 'W', 'device_class': 'power', 'tier': 'fast', 'deadband': 10, 'deadband_pct': 1},
+        'voltage': {'register': 1271, 'length': 1, 'scale': 0.1, 'unit': 'V', 'device_class': 'voltage'},
+        'current': {'register': 1281, 'length': 2, 'signed': True, 'scale': 0.1, 'unit': 'A', 'device_class': 'current', 'tier': 'fast', 'deadband': 0.2},
+        'energy': {'register': 1301, 'length': 4, 'signed': True, 'scale': 0.001, 'unit': 'kWh', 'device_class': 'energy', 'state_class': 'total_increasing'}
+    },
+    'inverter': {
+        'state': {'register': 64, 'length': 1, 'enum': operating_state},
+        'enabled': {'register': 66, 'length': 1, 'tier': 'slow', 'writable': True, 'min': 0, 'max': 1},
+        'faults': {'register': 68, 'length': 1, 'tier': 'slow'},
+        'warnings': {'register': 69, 'length': 1, 'tier': 'slow'},
+        'status': {'register': 122, 'length': 1, 'enum': inverter_status},
+        'load': {'register': 120, 'length': 1, 'unit': 'W', 'device_class': 'power', 'tier': 'fast', 'deadband': 10, 'deadband_pct': 1},
+        'ac_in_volts': {'register': 126, 'length': 1, 'scale': 0.1, 'unit': 'V', 'device_class': 'voltage', 'deadband': 0.5},
+        'ac_in_freq': {'register': 130, 'length': 1, 'scale': 0.1, 'unit': 'Hz', 'device_class': 'frequency'},
+        'ac_out_volts': {'register': 142, 'length': 1, 'scale': 0.1, 'unit': 'V', 'device_class': 'voltage', 'deadband': 0.5},
+        'ac_out_freq': {'register': 146, 'length': 1, 'scale': 0.1, 'unit': 'Hz', 'device_class': 'frequency'},
+        'battery_volts': {'register': 154, 'length': 1, 'unit': 'V', 'device_class': 'voltage'},
+        'force_charger_state': {'register': 357, 'length': 1, 'enum': force_charger_state, 'tier': 'slow', 'writable': True},
+        'max_charge_rate': {'register': 372, 'length': 1, 'unit': '%', 'tier': 'slow', 'writable': True, 'min': 0, 'max': 100},
+    },
+    'cc': {
+        'state': {'register': 64, 'length': 1, 'enum': operating_state},
+        'faults': {'register': 68, 'length': 1, 'enum': cc_faults, 'enum_default': 'No Active Faults', 'tier': 'slow'},
+        'warnings': {'register': 69, 'length': 1, 'enum': cc_warnings, 'enum_default': 'No Active Warnings', 'tier': 'slow'},
+        'status': {'register': 73, 'length': 1, 'enum': cc_status},
+        'pv_volts': {'register': 76, 'length': 1, 'scale': 0.1, 'unit': 'V', 'device_class': 'voltage'},
+        'pv_amps': {'register': 78, 'length': 1, 'scale': 0.1, 'unit': 'A', 'device_class': 'current'},
+        'battery_volts': {'register': 80, 'length': 1, 'unit': 'V', 'device_class': 'voltage'},
+        'output_power': {'register': 88, 'length': 1, 'scale': 0.1, 'unit': 'W', 'device_class': 'power', 'tier': 'fast', 'deadband': 5, 'deadband_pct': 1},
+        'daily_kwh': {'register': 90, 'length': 1, 'scale': 0.1, 'unit': 'kWh', 'device_class': 'energy', 'state_class': 'total_increasing'},
+        'aux_status': {'register': 92, 'length': 1},
+        'force_charger_state': {'register': 170, 'length': 1, 'enum': force_charger_state, 'tier': 'slow', 'writable': True},
+        'association': {'register': 249, 'length': 1, 'enum': solar_association, 'tier': 'slow'}
+    },
+    'ags': {
+        'state': {'register': 64, 'length': 1, 'enum': operating_state},
+        'faults': {'register': 68, 'length': 1, 'tier': 'slow'},
+        'warnings': {'register': 69, 'length': 1, 'tier': 'slow'},
+        'gen_state': {'register': 70, 'length': 1, 'enum': ags_state},
+        'start_mode': {'register': 72, 'length': 1, 'tier': 'slow'},
+        'generator_mode': {'register': 77, 'length': 1, 'enum': generator_mode, 'tier': 'slow', 'writable': True}
+    },
+    'scp': {
+        'state': {'register': 64, 'length': 1, 'enum': operating_state},
+        'faults': {'register': 68, 'length': 1, 'tier': 'slow'},
+        'warnings': {'register': 69, 'length': 1, 'tier': 'slow'},
+        'display_status': {'register': 70, 'length': 1, 'enum': scp_status}
+    },
+    'gridtie': {
+        'state': {'register': 64, 'length': 1, 'enum': operating_state},
+        'faults': {'register': 68, 'length': 1, 'tier': 'slow'},
+        'warnings': {'register': 69, 'length': 1, 'tier': 'slow'},
+        'pv_volts': {'register': 76, 'length': 1, 'scale': 0.1, 'unit': 'V', 'device_class': 'voltage'},
+        'pv_power': {'register': 88, 'length': 1, 'scale': 0.1, 'unit': 'W', 'device_class': 'power', 'tier': 'fast', 'deadband': 5, 'deadband_pct': 1}
+    }
+}
+
+tier_intervals = {
+    'fast': FAST_POLL_INTERVAL,
+    'normal': POLL_INTERVAL,
+    'slow': SLOW_POLL_INTERVAL,
+}
+
+# struct formats for big-endian integers by length in words
+int_formats = {1: 'h', 2: 'i', 4: 'q'}
+
+class RegisterDecoder:
+    """Decodes one register's raw words into its published value."""
+    __slots__ = ('name', 'register', 'length', 'scale', 'offset', 'digits', 'enum', 'enum_default',
+                 'unit', 'device_class', 'state_class', 'interval', 'deadband', 'deadband_pct', 'writable', 'min', 'max',
+                 'words', 'number')
+
+    def __init__(self, name, spec):
+        self.name = name
+        self.register = spec['register']
+        self.length = spec['length']
+        self.scale = spec.get('scale', 1)
+        self.offset = spec.get('offset', 0)
+        # Round scaled values to the scale's precision so 0.1 steps don't come out as 2.6000000000000005
+        self.digits = max(0, -math.floor(math.log10(self.scale))) if self.scale < 1 else None
+        self.enum = spec.get('enum')
+        self.enum_default = spec.get('enum_default', 'Unknown')
+        self.unit = spec.get('unit', '')
+        self.device_class = spec.get('device_class')
+        self.state_class = spec.get('state_class')
+        tier = spec.get('tier', 'normal')
+        self.interval = tier_intervals[tier] if tier in tier_intervals else float(tier)
+        self.deadband = spec.get('deadband', 0)
+        self.deadband_pct = spec.get('deadband_pct', 0)
+        self.writable = spec.get('writable', False)
+        self.min = spec.get('min')
+        self.max = spec.get('max')
+        self.words = struct.Struct(f'>{self.length}H')
+        if spec.get('type') == 'string':
+            self.number = None
+        elif self.length in int_formats:
+            int_format = int_formats[self.length]
+            self.number = struct.Struct('>' + (int_format if spec.get('signed') else int_format.upper()))
+        else:
+            raise ValueError(f"Register {name} has unsupported length {self.length}")
+
+    def decode(self, hold_reg_arr):
+        raw_bytes = self.words.pack(*hold_reg_arr)
+        if self.number is None:
+            return raw_bytes.decode('ascii', 'ignore').replace('\x00', '').strip()
+        value = self.number.unpack(raw_bytes)[0]
+        if self.enum is not None:
+            return self.enum.get(value, self.enum_default)
+        if self.scale == 1 and self.offset == 0:
+            return value
+        value = value * self.scale + self.offset
+        return round(value, self.digits) if self.digits is not None else value
+
+    def encode(self, value):
+        """Return the raw words for value; enum registers take the label or its number."""
+        if self.number is None:
+            raise ValueError(f"{self.name} can't be written")
+        if self.enum is not None:
+            if isinstance(value, str):
+                raw = next((key for key, label in self.enum.items() if label.lower() == value.lower()), None)
+            else:
+                raw = value if value in self.enum else None
+            if raw is None:
+                raise ValueError(f"{self.name} must be one of {list(self.enum.values())}")
+        else:
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"{self.name} must be a number")
+            if (self.min is not None and value < self.min) or (self.max is not None and value > self.max):
+                raise ValueError(f"{self.name} must be between {self.min} and {self.max}")
+            raw = round((value - self.offset) / self.scale)
+        try:
+            return list(self.words.unpack(self.number.pack(raw)))
+        except struct.error:
+            raise ValueError(f"{value} is out of range for {self.name}")
+
+def compile_decoders(registers_data):
+    return {
+        device: {register_name: RegisterDecoder(register_name, spec) for register_name, spec in registers.items()}
+        for device, registers in registers_data.items()
+    }
+
+# Compiled once at startup; the poll loop only ever touches these
+register_decoders = compile_decoders(registers_data)
+
+def register_interval(device, register_name):
+    return register_decoders[device][register_name].interval
+
+def device_intervals(device):
+    return sorted({decoder.interval for decoder in register_decoders.get(device, {}).values()})
+
+def register_max_age(device, register_name):
+    return SNAPSHOT_MAX_AGE * register_interval(device, register_name) / POLL_INTERVAL
+
 # Global gateways dict
 gateways = {}
 
-# Track failed devices to avoid repeated queries
-failed_devices = {}
+class CircuitBreaker:
+    """Stops polling a failing gateway or device and probes it with exponential backoff.
 
-# Load config.json
-def load_config():
-    global gateways
-    config_path = '/app/config.json'
-    gateways_config = []
-    if os.path.exists(config_path):
-        with open(config_path, 'r') as f:
-            try:
-                raw_config = json.load(f)
-                logger.info(f"Raw config content: {raw_config}")
-                logger.info(f"Config loaded as type: {type(raw_config)}")
-                if isinstance(raw_config, str):
-                    try:
-                        gateways_config = json.loads(raw_config)
-                    except json.JSONDecodeError as e:
-                        logger.error(f"JSON decode error in string config: {str(e)}")
-                        gateways_config = []
-                elif isinstance(raw_config, dict):
-                    logger.info("Config is dict; converting to list")
-                    gateways_config = [raw_config[k] for k in sorted(raw_config.keys(), key=int) if k.isdigit() and isinstance(raw_config[k], dict)]
-                elif isinstance(raw_config, list):
-                    gateways_config = raw_config
+    After failure_threshold consecutive failures the breaker opens and calls are
+    refused for base_delay seconds, doubling on every failed probe up to
+    max_delay. Once the delay has passed calls are let through again as probes
+    (half-open); the first success closes the breaker, a failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, base_delay=10, max_delay=600):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self._consecutive_trips = 0
+        self._open_until = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if monotonic() < self._open_until:
+                    return False
+                self.state = self.HALF_OPEN
+                logger.info(f"Circuit for {self.name} half-open; probing")
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"Circuit for {self.name} closed")
+            self.state = self.CLOSED
+            self.failures = 0
+            self._consecutive_trips = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self._consecutive_trips += 1
+                self.trips += 1
+                breaker_trips.labels(self.name).inc()
+                delay = min(self.base_delay * 2 ** (self._consecutive_trips - 1), self.max_delay)
+                self._open_until = monotonic() + delay
+                self.state = self.OPEN
+                logger.warning(f"Circuit for {self.name} open after {self.failures} failures; next probe in {delay}s")
+
+    def status(self):
+        with self._lock:
+            status = {'state': self.state, 'failures': self.failures, 'trips': self.trips}
+            if self.state == self.OPEN:
+                status['retry_in'] = round(max(0, self._open_until - monotonic()), 1)
+            return status
+
+# Circuit breakers keyed on gateway name or gateway_device_instance
+breakers = {}
+breakers_lock = threading.Lock()
+
+def get_breaker(name, failure_threshold=5):
+    with breakers_lock:
+        if name not in breakers:
+            breakers[name] = CircuitBreaker(name, failure_threshold=failure_threshold)
+        return breakers[name]
+
+# Modbus connection pools keyed on (ip, port)
+modbus_pools = {}
+modbus_pools_lock = threading.Lock()
+
+class ModbusExceptionError(ValueError):
+    pass
+
+class ModbusTimeoutError(ValueError):
+    pass
+
+def read_error_type(e):
+    if isinstance(e, ModbusTimeoutError):
+        return 'timeout'
+    if isinstance(e, ModbusExceptionError):
+        return 'modbus_exception'
+    if isinstance(e, ConnectionError):
+        return 'connect'
+    if isinstance(e, ValueError):
+        return 'no_data'
+    return 'other'
+
+class ModbusConnectionPool:
+    """Keeps Modbus TCP sockets to one gateway open across polls.
+
+    Sockets are shared between devices on the gateway by switching unit_id per
+    request. At most max_connections sockets are open at once, idle sockets are
+    closed after idle_timeout seconds and failed connects back off exponentially.
+    Requests are spaced at least request_delay seconds apart. A pool created
+    with shared_limits takes its sockets and request spacing from that pool's.
+    """
+    def __init__(self, name, host, port, timeout=5, max_connections=2, idle_timeout=60, request_delay=0.1, backoff_base=1, backoff_max=60,
+                 shared_limits=None):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.request_delay = request_delay
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._idle = []  # [(client, last_used)]
+        self._connect_failures = 0
+        self._retry_at = 0
+        self._throttle_lock = threading.Lock()
+        self._next_request = 0
+        if shared_limits is not None:
+            self.max_connections = shared_limits.max_connections
+            self._slots = shared_limits._slots
+            self._throttle = shared_limits._throttle
+
+    def _throttle(self):
+        # Waiters queue on the lock so requests to the gateway go out one at a time
+        with self._throttle_lock:
+            wait = self._next_request - monotonic()
+            if wait > 0:
+                sleep(wait)
+            self._next_request = monotonic() + self.request_delay
+
+    def _open_client(self, unit_id):
+        now = monotonic()
+        with self._lock:
+            if now < self._retry_at:
+                raise ConnectionError(f"Reconnect to {self.host}:{self.port} backing off for {self._retry_at - now:.1f}s")
+        client = ModbusClient(host=self.host, port=self.port, unit_id=unit_id, timeout=self.timeout, auto_open=False, auto_close=False)
+        started = monotonic()
+        opened = client.open()
+        modbus_connect_seconds.labels(self.name).observe(monotonic() - started)
+        if not opened:
+            with self._lock:
+                self._connect_failures += 1
+                delay = min(self.backoff_base * 2 ** (self._connect_failures - 1), self.backoff_max)
+                self._retry_at = monotonic() + delay
+            raise ConnectionError(f"Failed to connect to {self.host}:{self.port} ({client.last_error_as_txt}), retrying in {delay}s")
+        with self._lock:
+            self._connect_failures = 0
+            self._retry_at = 0
+        logger.debug(f"Opened Modbus connection to {self.host}:{self.port}")
+        return client
+
+    def _checkout(self, unit_id):
+        # Health check idle sockets before reuse; anything closed or stale is dropped
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                client, last_used = self._idle.pop()
+            if client.is_open and monotonic() - last_used < self.idle_timeout:
+                client.unit_id = unit_id
+                return client, True
+            client.close()
+        return self._open_client(unit_id), False
+
+    def _checkin(self, client):
+        # Keep the socket only if the last request left it usable
+        if client.is_open and client.last_error in (MB_NO_ERR, MB_EXCEPT_ERR):
+            with self._lock:
+                self._idle.append((client, monotonic()))
+        else:
+            client.close()
+
+    @contextmanager
+    def connection(self, unit_id):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise ConnectionError(f"No free connection to {self.host}:{self.port} (max {self.max_connections})")
+        client = None
+        try:
+            client, reused = self._checkout(unit_id)
+            client.reused = reused
+            yield client
+        except BaseException:
+            if client is not None:
+                client.close()
+                client = None
+            raise
+        finally:
+            if client is not None:
+                self._checkin(client)
+            self._slots.release()
+
+    def read_holding_registers(self, unit_id, register, reg_len):
+        # A reused socket may have been dropped by the gateway, so retry once on a fresh one
+        for attempt in range(2):
+            with self.connection(unit_id) as client:
+                self._throttle()
+                hold_reg_arr = client.read_holding_registers(register, reg_len)
+                if hold_reg_arr is not None:
+                    return hold_reg_arr
+                if client.last_error == MB_EXCEPT_ERR:
+                    raise ModbusExceptionError(f"Modbus exception reading register {register} from unit {unit_id}: {client.last_except_as_txt}")
+                # Timeouts are not retried; a silent device would cost the timeout twice
+                if client.last_error == MB_TIMEOUT_ERR:
+                    raise ModbusTimeoutError(f"Timed out reading register {register} from unit {unit_id}")
+                if not client.reused or attempt:
+                    raise ValueError(f"No data returned from register {register} for unit {unit_id}: {client.last_error_as_txt}")
+
+    def write_registers(self, unit_id, register, words):
+        # Setpoint writes are idempotent, so a write on a dropped socket is retried like a read
+        for attempt in range(2):
+            with self.connection(unit_id) as client:
+                self._throttle()
+                if len(words) == 1:
+                    written = client.write_single_register(register, words[0])
                 else:
-                    logger.error(f"Config is unexpected type {type(raw_config)}; forcing to empty list")
-                    gateways_config = []
-            except json.JSONDecodeError as e:
-                logger.error(f"JSON decode error: {str(e)}")
-                gateways_config = []
-            except Exception as e:
-                logger.error(f"Unexpected error loading config: {str(e)}")
-                gateways_config = []
-    else:
-        logger.warning("Config file not found; using empty list")
-        gateways_config = []
+                    written = client.write_multiple_registers(register, words)
+                if written:
+                    return
+                if client.last_error == MB_EXCEPT_ERR:
+                    raise ModbusExceptionError(f"Modbus exception writing register {register} on unit {unit_id}: {client.last_except_as_txt}")
+                if client.last_error == MB_TIMEOUT_ERR:
+                    raise ModbusTimeoutError(f"Timed out writing register {register} on unit {unit_id}")
+                if not client.reused or attempt:
+                    raise ValueError(f"Write to register {register} on unit {unit_id} failed: {client.last_error_as_txt}")
+
+    def reap(self):
+        now = monotonic()
+        with self._lock:
+            stale = [c for c, last_used in self._idle if now - last_used >= self.idle_timeout]
+            self._idle = [(c, t) for c, t in self._idle if now - t < self.idle_timeout]
+        for client in stale:
+            client.close()
+        if stale:
+            logger.debug(f"Closed {len(stale)} idle Modbus connections to {self.host}:{self.port}")
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for client, _ in idle:
+            client.close()
 
-    # Build gateways dict and publish MQTT discovery
-    for idx, gw in enumerate(gateways_config):
+def get_pool(gateway):
+    gw_config = gateways[gateway]
+    key = (gw_config['ip'], gw_config['port'])
+    with modbus_pools_lock:
+        pool = modbus_pools.get(key)
+        if pool is None:
+            pool = ModbusConnectionPool(
+                gateway, gw_config['ip'], gw_config['port'],
+                timeout=gw_config['timeout'],
+                max_connections=gw_config['max_connections'],
+                idle_timeout=gw_config['idle_timeout'],
+                request_delay=gw_config['request_delay']
+            )
+            modbus_pools[key] = pool
+        return pool
+
+# Background thread to close idle Modbus connections
+def reap_modbus_pools():
+    while True:
+        sleep(10)
+        with modbus_pools_lock:
+            pools = list(modbus_pools.values())
+        for pool in pools:
+            pool.reap()
+
+# Config list key of each device type
+device_list_keys = {
+    'battery': 'batteries',
+    'powermeter': 'powermeter',
+    'inverter': 'inverters',
+    'cc': 'charge_controllers',
+    'ags': 'ags',
+    'scp': 'scp',
+    'gridtie': 'gridtie'
+}
+
+# Every Conext device reports its name as an ASCII block at register 0
+device_name_decoder = RegisterDecoder('device_name', {'register': 0, 'length': 8, 'type': 'string'})
+
+# Words in a device name that identify its type, checked in order
+device_name_keywords = [
+    ('cc', ('mppt', 'charge', 'cc')),
+    ('inverter', ('xw', 'sw', 'inverter')),
+    ('ags', ('ags', 'generator')),
+    ('scp', ('scp', 'panel')),
+    ('gridtie', ('cl', 'gt', 'rl', 'gridtie')),
+    ('battery', ('battery', 'bmon', 'bms')),
+    ('powermeter', ('meter', 'pm', 'em'))
+]
+
+# Default unit-ID ranges, used when the name gives nothing away
+unit_id_ranges = [
+    ('inverter', range(10, 20)),
+    ('cc', range(30, 40)),
+    ('scp', range(40, 50)),
+    ('ags', range(50, 60)),
+    ('gridtie', range(60, 70)),
+    ('cc', range(170, 180)),
+    ('battery', range(190, 200))
+]
+
+def parse_unit_ids(spec):
+    """Parse '1-20,30,190-199' into a sorted list of unit IDs."""
+    unit_ids = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = part.split('-', 1)
+            unit_ids.update(range(int(first), int(last) + 1))
+        elif part:
+            unit_ids.add(int(part))
+    return sorted(unit_ids)
+
+def classify_device(device_name, unit_id):
+    words = re.findall(r'[a-z]+', device_name.lower())
+    for device_type, keywords in device_name_keywords:
+        if any(word.startswith(keyword) for word in words for keyword in keywords):
+            return device_type
+    for device_type, unit_range in unit_id_ranges:
+        if unit_id in unit_range:
+            return device_type
+    return None
+
+# Tries per unit ID before a dropped or refused connection fails the whole scan
+SCAN_ATTEMPTS = 3
+
+def scan_gateway(gateway):
+    """Probe the SCAN_UNIT_IDS on a configured gateway and return {device_type: [{'name', 'unit_id'}]}.
+
+    Raises ConnectionError if a unit ID could not be probed, rather than
+    reporting a partial scan.
+    """
+    gw_config = gateways[gateway]
+    # The scan's sockets use its short timeout but count against the polling pool's
+    # max_connections and request spacing; one socket is left free for polling
+    polling_pool = get_pool(gateway)
+    workers = max(1, min(SCAN_WORKERS, polling_pool.max_connections - 1))
+    pool = ModbusConnectionPool(f"{gateway}_scan", gw_config['ip'], gw_config['port'], timeout=SCAN_TIMEOUT,
+                                backoff_max=SCAN_TIMEOUT, shared_limits=polling_pool)
+    failed = threading.Event()
+
+    def probe(unit_id):
+        for attempt in range(SCAN_ATTEMPTS):
+            if failed.is_set():
+                return None
+            try:
+                hold_reg_arr = pool.read_holding_registers(unit_id, device_name_decoder.register, device_name_decoder.length)
+            except (ModbusExceptionError, ModbusTimeoutError):
+                # An exception response or no answer at all means no device at this unit ID
+                return None
+            except (ConnectionError, ValueError) as e:
+                error = e
+                sleep(SCAN_TIMEOUT)
+                continue
+            return unit_id, ''.join(c for c in device_name_decoder.decode(hold_reg_arr) if c.isprintable()).strip()
+        failed.set()
+        raise ConnectionError(f"Scan of {gateway} failed at unit {unit_id}: {str(error)}")
+
+    started = monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            found = [result for result in executor.map(probe, parse_unit_ids(SCAN_UNIT_IDS)) if result]
+    finally:
+        pool.close()
+
+    devices = {}
+    names = set()
+    for unit_id, device_name in found:
+        device_type = classify_device(device_name, unit_id)
+        if device_type is None:
+            logger.info(f"Skipping unit {unit_id} on {gateway}: unrecognised device '{device_name}'")
+            continue
+        # Names end up in MQTT topics and URLs
+        device_name = re.sub(r'[^A-Za-z0-9_-]+', '_', device_name).strip('_') or f"{device_type}_{unit_id}"
+        if device_name in names:
+            device_name = f"{device_name}_{unit_id}"
+        names.add(device_name)
+        devices.setdefault(device_type, []).append({'name': device_name, 'unit_id': unit_id})
+    logger.info(f"Scanned {gateway} in {monotonic() - started:.1f}s: "
+                f"{sum(len(d) for d in devices.values())} devices on {len(found)} responding units")
+    return devices
+
+# Scan results keyed on "ip:port", loaded from SCAN_CACHE on first use
+scan_results = None
+scan_lock = threading.Lock()
+# Gateways ("ip:port") being scanned, and the error of each one's last failed scan
+scans_running = set()
+scan_errors = {}
+
+def load_scan_cache():
+    if not SCAN_CACHE or not os.path.exists(SCAN_CACHE):
+        return {}
+    try:
+        with open(SCAN_CACHE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to read scan cache {SCAN_CACHE}: {str(e)}")
+        return {}
+
+def cached_scan(ip, port):
+    """Return (devices, fresh) from the scan cache, or (None, False) if the gateway was never scanned."""
+    global scan_results
+    with scan_lock:
+        if scan_results is None:
+            scan_results = load_scan_cache()
+        entry = scan_results.get(f"{ip}:{port}")
+    if entry is None:
+        return None, False
+    return entry['devices'], time() - entry['scanned'] < SCAN_TTL
+
+def start_scan(gateway):
+    """Scan a configured gateway in the background, unless it is already being scanned.
+
+    The configuration is reloaded when the scan succeeds, so its device lists
+    take effect without blocking the caller.
+    """
+    key = f"{gateways[gateway]['ip']}:{gateways[gateway]['port']}"
+    with scan_lock:
+        if key in scans_running:
+            return
+        scans_running.add(key)
+    threading.Thread(target=run_scan, args=(gateway, key), daemon=True).start()
+
+def run_scan(gateway, key):
+    try:
+        devices = scan_gateway(gateway)
+    except (ConnectionError, KeyError) as e:
+        # KeyError: the gateway was removed from the configuration before the scan started
+        logger.error(f"Device scan of {gateway} failed: {str(e)}")
+        with scan_lock:
+            scans_running.discard(key)
+            scan_errors[key] = str(e)
+        return
+    with scan_lock:
+        scans_running.discard(key)
+        scan_errors.pop(key, None)
+        scan_results[key] = {'scanned': time(), 'devices': devices}
+        if SCAN_CACHE:
+            try:
+                with open(SCAN_CACHE, 'w') as f:
+                    json.dump(scan_results, f)
+            except OSError as e:
+                logger.error(f"Failed to write scan cache {SCAN_CACHE}: {str(e)}")
+    load_config()
+
+def with_scanned_devices(gw):
+    """Return (gw with empty device lists filled in from the scan cache, whether it needs a new scan)."""
+    # Device lists written in the config take precedence over scanned ones
+    devices, fresh = cached_scan(gw['ip'], gw.get('port', 503))
+    merged = dict(gw)
+    for device_type, list_key in device_list_keys.items():
+        if not merged.get(list_key) and (devices or {}).get(device_type):
+            merged[list_key] = devices[device_type]
+    return merged, not fresh
+
+# Retained discovery payloads last published, keyed by topic
+discovery_cache = {}
+config_lock = threading.Lock()
+
+# Gateway settings that require a new connection pool when changed
+connection_settings = ('ip', 'port', 'timeout', 'max_connections', 'idle_timeout', 'request_delay')
+
+def read_config_file(config_path=CONFIG_PATH):
+    """Return the list of gateway configs, or None if the file could not be parsed."""
+    if not os.path.exists(config_path):
+        logger.warning("Config file not found; using empty list")
+        return []
+    with open(config_path, 'r') as f:
         try:
-            name = gw['name']
-            device_ids = {
-                'battery': {d['name']: d['unit_id'] for d in gw.get('batteries', []) if isinstance(d, dict)},
-                'powermeter': {d['name']: d['unit_id'] for d in gw.get('powermeter', []) if isinstance(d, dict)},
-                'inverter': {d['name']: d['unit_id'] for d in gw.get('inverters', []) if isinstance(d, dict)},
-                'cc': {d['name']: d['unit_id'] for d in gw.get('charge_controllers', []) if isinstance(d, dict)},
-                'ags': {d['name']: d['unit_id'] for d in gw.get('ags', []) if isinstance(d, dict)},
-                'scp': {d['name']: d['unit_id'] for d in gw.get('scp', []) if isinstance(d, dict)},
-                'gridtie': {d['name']: d['unit_id'] for d in gw.get('gridtie', []) if isinstance(d, dict)}
-            }
-            gateways[name] = {
-                'ip': gw['ip'],
-                'port': gw.get('port', 503),
-                'timeout': gw.get('timeout', 5),
-                'device_ids': device_ids
+            raw_config = json.load(f)
+            logger.info(f"Raw config content: {raw_config}")
+            logger.info(f"Config loaded as type: {type(raw_config)}")
+            if isinstance(raw_config, str):
+                try:
+                    return json.loads(raw_config)
+                except json.JSONDecodeError as e:
+                    logger.error(f"JSON decode error in string config: {str(e)}")
+                    return None
+            elif isinstance(raw_config, dict):
+                logger.info("Config is dict; converting to list")
+                return [raw_config[k] for k in sorted(raw_config.keys(), key=int) if k.isdigit() and isinstance(raw_config[k], dict)]
+            elif isinstance(raw_config, list):
+                return raw_config
+            else:
+                logger.error(f"Config is unexpected type {type(raw_config)}; forcing to empty list")
+                return []
+        except json.JSONDecodeError as e:
+            logger.error(f"JSON decode error: {str(e)}")
+            return None
+        except Exception as e:
+            logger.error(f"Unexpected error loading config: {str(e)}")
+            return None
+
+def write_config_file(gateways_config, config_path=CONFIG_PATH):
+    # Replace the file in one step so the watcher never reads it half written
+    os.makedirs(os.path.dirname(config_path) or '.', exist_ok=True)
+    with open(f"{config_path}.tmp", 'w') as f:
+        json.dump(gateways_config, f, indent=2)
+    os.replace(f"{config_path}.tmp", config_path)
+
+def build_discovery(name, device_ids):
+    """Return {topic: payload} of the MQTT discovery configs for a gateway's devices."""
+    discovery = {}
+    for device_type, devices in device_ids.items():
+        for device_name, unit_id in devices.items():
+            device_id = f"{name}_{device_name}"
+            device_config = {
+                "name": device_name,
+                "identifiers": [device_id],
+                "manufacturer": "Schneider Electric",
+                "model": device_type.capitalize(),
+                "via_device": name
             }
-            
-            # Publish MQTT discovery for each device
-            for device_type, devices in device_ids.items():
-                for device_name, unit_id in devices.items():
-                    device_id = f"{name}_{device_name}"
-                    device_config = {
-                        "name": device_name,
-                        "identifiers": [device_id],
-                        "manufacturer": "Schneider Electric",
-                        "model": device_type.capitalize(),
-                        "via_device": name
-                    }
-                    for register_name in registers_data[device_type]:
-                        entity_id = f"sensor.{device_id}_{register_name}"
-                        topic = f"{MQTT_DISCOVERY_PREFIX}/sensor/{device_id}/{register_name}/config"
-                        unit = ""
-                        if device_type == "battery":
-                            if register_name == "voltage" or register_name == "battery_volts":
-                                unit = "V"
-                            elif register_name == "temperature":
-                                unit = "°C"
-                            elif register_name in ["soc", "soh"]:
-                                unit = "%"
-                        elif device_type == "powermeter":
-                            if register_name == "power":
-                                unit = "W"
-                            elif register_name == "voltage":
-                                unit = "V"
-                            elif register_name == "current":
-                                unit = "A"
-                            elif register_name == "energy":
-                                unit = "kWh"
-                        elif device_type == "inverter":
-                            if register_name in ["ac_in_volts", "ac_out_volts", "battery_volts"]:
-                                unit = "V"
-                            elif register_name in ["ac_in_freq", "ac_out_freq"]:
-                                unit = "Hz"
-                            elif register_name == "load":
-                                unit = "W"
-                        elif device_type == "cc":
-                            if register_name in ["pv_volts", "battery_volts"]:
-                                unit = "V"
-                            elif register_name == "pv_amps":
-                                unit = "A"
-                            elif register_name in ["output_power", "daily_kwh"]:
-                                unit = "W" if register_name == "output_power" else "kWh"
-                        config = {
-                            "name": f"{device_name} {register_name.replace('_', ' ').title()}",
-                            "state_topic": f"conext/{name}/{device_type}/{device_name}/{register_name}",
-                            "unique_id": entity_id,
-                            "device": device_config,
-                            "unit_of_measurement": unit,
-                            "value_template": "{{ value_json.value }}"
-                        }
-                        mqtt_client.publish(topic, json.dumps(config), retain=True)
-        except KeyError as e:
-            logger.error(f"Missing key in gateway config at index {idx}: {str(e)}")
-            continue
-        except TypeError as e:
-            logger.error(f"Type error in gateway config at index {idx}: {str(e)}")
-            continue
+            for register_name, decoder in register_decoders[device_type].items():
+                entity_id = f"sensor.{device_id}_{register_name}"
+                topic = f"{MQTT_DISCOVERY_PREFIX}/sensor/{device_id}/{register_name}/config"
+                config = {
+                    "name": f"{device_name} {register_name.replace('_', ' ').title()}",
+                    "state_topic": f"conext/{name}/{device_type}/{device_name}/{register_name}",
+                    "unique_id": entity_id,
+                    "device": device_config,
+                    "unit_of_measurement": decoder.unit,
+                    "value_template": "{{ value_json.value }}"
+                }
+                if MQTT_AGGREGATE:
+                    config["state_topic"] = f"conext/{name}/{device_type}/{device_name}/state"
+                    config["value_template"] = f"{{{{ value_json.{register_name} }}}}"
+                if decoder.device_class:
+                    config["device_class"] = decoder.device_class
+                if decoder.state_class:
+                    config["state_class"] = decoder.state_class
+                discovery[topic] = json.dumps(config)
+    return discovery
+
+def sync_discovery(discovery):
+    # Only new or changed configs are published; configs of removed entities are cleared
+    published = 0
+    for topic, payload in discovery.items():
+        if discovery_cache.get(topic) != payload:
+            mqtt_publish(topic, payload, retain=True)
+            published += 1
+    cleared = 0
+    for topic in set(discovery_cache) - set(discovery):
+        mqtt_publish(topic, '', retain=True)
+        cleared += 1
+    discovery_cache.clear()
+    discovery_cache.update(discovery)
+    return published, cleared
+
+def device_keys(gateways_dict):
+    return {
+        (name, device_type, device_name)
+        for name, gw_config in gateways_dict.items()
+        for device_type, devices in gw_config['device_ids'].items()
+        for device_name in devices
+    }
+
+# Load config.json; on reload only what changed is torn down or republished
+def load_config():
+    global gateways
+    with config_lock:
+        gateways_config = read_config_file()
+        if gateways_config is None:
+            if gateways:
+                logger.error("Keeping the current configuration")
+                return {'error': 'Config file could not be parsed; keeping the current configuration'}
+            gateways_config = []
+
+        # Build gateways dict and MQTT discovery
+        new_gateways = {}
+        discovery = {}
+        to_scan = []
+        for idx, gw in enumerate(gateways_config):
+            try:
+                name = gw['name']
+                if gw.get('scan'):
+                    # Cached device lists are used meanwhile, even when expired
+                    gw, stale = with_scanned_devices(gw)
+                    if stale:
+                        to_scan.append(name)
+                device_ids = {
+                    device_type: {d['name']: d['unit_id'] for d in gw.get(list_key, []) if isinstance(d, dict)}
+                    for device_type, list_key in device_list_keys.items()
+                }
+                new_gateways[name] = {
+                    'ip': gw['ip'],
+                    'port': gw.get('port', 503),
+                    'timeout': gw.get('timeout', 5),
+                    'max_connections': gw.get('max_connections', 2),
+                    'idle_timeout': gw.get('idle_timeout', 60),
+                    'max_register_gap': gw.get('max_register_gap', 16),
+                    'request_delay': gw.get('request_delay', 0.1),
+                    'device_ids': device_ids
+                }
+                discovery.update(build_discovery(name, device_ids))
+            except KeyError as e:
+                logger.error(f"Missing key in gateway config at index {idx}: {str(e)}")
+                continue
+            except TypeError as e:
+                logger.error(f"Type error in gateway config at index {idx}: {str(e)}")
+                continue
+
+        old_gateways = gateways
+        added = [name for name in new_gateways if name not in old_gateways]
+        removed = [name for name in old_gateways if name not in new_gateways]
+        changed = [
+            name for name in new_gateways if name in old_gateways and new_gateways[name] != old_gateways[name]
+        ]
+        reconnect = [
+            name for name in changed
+            if any(new_gateways[name][key] != old_gateways[name][key] for key in connection_settings)
+        ]
+        gateways = new_gateways
+
+        # Pools and breakers of untouched gateways and devices are kept
+        stale_pools = {(old_gateways[name]['ip'], old_gateways[name]['port']) for name in removed + reconnect}
+        stale_pools -= {(gw_config['ip'], gw_config['port']) for name, gw_config in new_gateways.items() if name not in reconnect}
+        with modbus_pools_lock:
+            pools = [modbus_pools.pop(key) for key in stale_pools if key in modbus_pools]
+        for pool in pools:
+            pool.close()
+        current_devices = device_keys(new_gateways)
+        with breakers_lock:
+            for breaker_name in list(breakers):
+                if breaker_name in removed or breaker_name in reconnect:
+                    del breakers[breaker_name]
+            for name, device_type, device_name in device_keys(old_gateways) - current_devices:
+                breakers.pop(f"{name}_{device_type}_{device_name}", None)
+        snapshot.prune(current_devices)
+        stream_hub.prune(current_devices)
+
+        # Derived metrics are re-resolved so wildcards pick up added or removed devices
+        derived_specs = read_derived_file()
+        if derived_specs is None:
+            derived_specs = derived.specs
+        # A cluster node only polls some of the gateways, so every node would publish its own
+        # partial sums and integrator totals to the same topics
+        if cluster is not None and derived_specs:
+            logger.warning("Derived metrics are not supported in cluster mode; ignoring them")
+            derived_specs = []
+        derived.configure(derived_specs, new_gateways)
+        discovery.update(derived.discovery())
+        published, cleared = sync_discovery(discovery)
+        for name in to_scan:
+            start_scan(name)
+
     if not gateways:
         logger.warning("No valid gateways configured")
     else:
         logger.info(f"Loaded gateways: {list(gateways.keys())}")
+    if old_gateways:
+        logger.info(f"Config reloaded: added {added}, removed {removed}, changed {changed}; "
+                    f"{published} discovery configs published, {cleared} cleared")
+    return {
+        'added': added,
+        'removed': removed,
+        'changed': changed,
+        'discovery_published': published,
+        'discovery_cleared': cleared
+    }
+
+# Background thread to reload the config when the file changes
+def watch_config():
+    last_mtime = os.path.getmtime(CONFIG_PATH) if os.path.exists(CONFIG_PATH) else None
+    while True:
+        sleep(CONFIG_WATCH_INTERVAL)
+        mtime = os.path.getmtime(CONFIG_PATH) if os.path.exists(CONFIG_PATH) else None
+        if mtime != last_mtime:
+            last_mtime = mtime
+            logger.info(f"{CONFIG_PATH} changed; reloading")
+            load_config()
+
+# Modbus allows at most 125 holding registers in one read
+MAX_READ_REGISTERS = 125
+
+ReadBlock = namedtuple('ReadBlock', ['start', 'count', 'registers'])
+
+read_plans = {}
+
+def compile_read_plan(decoders, max_gap=16):
+    """Group a device type's registers into the fewest block reads.
+
+    Registers separated by at most max_gap unused registers share a block as long
+    as the block stays within MAX_READ_REGISTERS. Each block lists its members as
+    (decoder, offset) so values can be sliced out of the result.
+    """
+    plan = []
+    for decoder in sorted(decoders, key=lambda decoder: decoder.register):
+        if plan:
+            block = plan[-1]
+            end = decoder.register + decoder.length
+            if decoder.register - (block.start + block.count) <= max_gap and end - block.start <= MAX_READ_REGISTERS:
+                block.registers.append((decoder, decoder.register - block.start))
+                plan[-1] = block._replace(count=max(block.count, end - block.start))
+                continue
+        plan.append(ReadBlock(decoder.register, decoder.length, [(decoder, 0)]))
+    return plan
+
+def get_read_plan(device, max_gap, interval=None):
+    # With an interval only the registers polled at that interval are planned
+    key = (device, max_gap, interval)
+    if key not in read_plans:
+        decoders = [
+            decoder for decoder in register_decoders.get(device, {}).values()
+            if interval is None or decoder.interval == interval
+        ]
+        read_plans[key] = compile_read_plan(decoders, max_gap)
+        logger.debug(f"Read plan for {device} (interval {interval}): {[(b.start, b.count) for b in read_plans[key]]}")
+    return read_plans[key]
+
+def read_block(pool, unit_id, block):
+    try:
+        hold_reg_arr = pool.read_holding_registers(unit_id, block.start, block.count)
+        return {decoder.name: hold_reg_arr[offset:offset + decoder.length] for decoder, offset in block.registers}
+    except ModbusExceptionError:
+        if len(block.registers) == 1:
+            raise
+    # Some register in a gap is not mapped on this device; fall back to single reads
+    logger.debug(f"Block read {block.start}+{block.count} rejected for unit {unit_id}; reading registers individually")
+    block_values = {}
+    for decoder, offset in block.registers:
+        try:
+            block_values[decoder.name] = pool.read_holding_registers(unit_id, decoder.register, decoder.length)
+        except Exception as e:
+            block_values[decoder.name] = e
+    return block_values
+
+class SnapshotStore:
+    """Latest decoded values per device, filled by the poller and read by the REST API."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._devices = {}  # (gateway, device, instance) -> {register_name: (value, timestamp, max_age)}
+        self._errors = {}  # (gateway, device, instance) -> {register_name: (error, timestamp, max_age)}
+
+    def update(self, gateway, device, instance, values, errors=None):
+        """Store polled values, and the last error of registers that failed to read."""
+        timestamp = time()
+        key = (gateway, device, instance)
+        with self._lock:
+            entry = self._devices.setdefault(key, {})
+            failed = self._errors.setdefault(key, {})
+            for register_name, value in values.items():
+                entry[register_name] = (value, timestamp, register_max_age(device, register_name))
+                failed.pop(register_name, None)
+            for register_name, error in (errors or {}).items():
+                failed[register_name] = (error, timestamp, register_max_age(device, register_name))
+
+    def prune(self, keep):
+        """Drop devices whose (gateway, device, instance) is not in keep."""
+        with self._lock:
+            for store in (self._devices, self._errors):
+                for key in list(store):
+                    if key not in keep:
+                        del store[key]
+
+    def values(self, gateway, device, instance):
+        """Return the latest {register_name: value} for a device regardless of age."""
+        with self._lock:
+            entry = self._devices.get((gateway, device, instance), {})
+            return {register_name: value for register_name, (value, _, _) in entry.items()}
+
+    def latest(self, gateway, device, instance):
+        """Return ({register_name: value}, oldest timestamp) regardless of age, or None if never polled."""
+        with self._lock:
+            entry = self._devices.get((gateway, device, instance))
+            if not entry:
+                return None
+            return {register_name: value for register_name, (value, _, _) in entry.items()}, min(timestamp for _, timestamp, _ in entry.values())
+
+    def get(self, gateway, device, instance):
+        """Return ({register_name: value}, oldest timestamp), or None unless every register is fresh.
+
+        A register without a fresh value still counts as fresh while its last
+        read error is, and is returned as that {'error': ...}.
+        """
+        now = time()
+        values = {}
+        oldest = None
+        with self._lock:
+            entry = self._devices.get((gateway, device, instance), {})
+            failed = self._errors.get((gateway, device, instance), {})
+            for register_name in register_decoders.get(device, {}):
+                value, timestamp, max_age = entry.get(register_name, (None, 0, 0))
+                if now - timestamp > max_age:
+                    error, timestamp, max_age = failed.get(register_name, (None, 0, 0))
+                    if now - timestamp > max_age:
+                        return None
+                    value = {'error': error}
+                values[register_name] = value
+                oldest = timestamp if oldest is None else min(oldest, timestamp)
+        if oldest is None:
+            return None
+        return values, oldest
+
+snapshot = SnapshotStore()
 
-# Load configuration at startup
-load_config()
+class SingleFlight:
+    """Collapses concurrent calls with the same key into one call whose result they all share."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
 
-def get_modbus_values(gateway, device, device_instance=None):
-    logger.info(f"Querying {gateway}/{device}/{device_instance}")
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event()}
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = fn()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+live_reads = SingleFlight()
+
+def publish_device_state(gateway, device, device_key, polled):
+    # The document carries every register, including ones polled on other intervals
+    state = snapshot.values(gateway, device, device_key)
+    state.update({register_name: value['error'] for register_name, value in polled.items() if isinstance(value, dict) and 'error' in value})
+    changed = False
+    for register_name, value in state.items():
+        decoder = register_decoders[device][register_name]
+        if publish_filter.check(f"conext/{gateway}/{device}/{device_key}/{register_name}", value, decoder.deadband, decoder.deadband_pct):
+            changed = True
+    publish_filter.count(changed)
+    if changed:
+        mqtt_publish(f"conext/{gateway}/{device}/{device_key}/state", json.dumps(state))
+
+class HistoryRing:
+    """Fixed-size ring of rows stored column-wise in array('d') buffers; the first column is time."""
+    __slots__ = ('columns', 'capacity', 'start', 'size')
+
+    def __init__(self, capacity, width):
+        self.columns = [array('d', bytes(8 * capacity)) for _ in range(width)]
+        self.capacity = capacity
+        self.start = 0
+        self.size = 0
+
+    def append(self, *row):
+        if self.size < self.capacity:
+            index = (self.start + self.size) % self.capacity
+            self.size += 1
+        else:
+            index = self.start
+            self.start = (self.start + 1) % self.capacity
+        for column, value in zip(self.columns, row):
+            column[index] = value
+
+    def oldest(self):
+        return self.columns[0][self.start] if self.size else float('inf')
+
+    def rows(self, t_from, t_to):
+        for i in range(self.size):
+            index = (self.start + i) % self.capacity
+            if t_from <= self.columns[0][index] <= t_to:
+                yield tuple(column[index] for column in self.columns)
+
+# Rollup resolution in seconds -> buckets kept (6 hours, 2 days, 7 days)
+rollup_capacities = {60: 360, 900: 192, 3600: 168}
+
+class RegisterHistory:
+    """Raw samples plus min/max/sum/count rollups for one register."""
+    __slots__ = ('raw', 'rollups', 'open_buckets')
+
+    def __init__(self):
+        self.raw = HistoryRing(HISTORY_RAW_SAMPLES, 2)
+        self.rollups = {resolution: HistoryRing(capacity, 5) for resolution, capacity in rollup_capacities.items()}
+        self.open_buckets = {}  # resolution -> [start, min, max, sum, count]
+
+    def record(self, timestamp, value):
+        """Add a sample and return the rollup buckets it closed as [(resolution, bucket)]."""
+        self.raw.append(timestamp, value)
+        closed = []
+        for resolution, ring in self.rollups.items():
+            start = timestamp - timestamp % resolution
+            bucket = self.open_buckets.get(resolution)
+            if bucket is not None and bucket[0] != start:
+                ring.append(*bucket)
+                closed.append((resolution, bucket))
+                bucket = None
+            if bucket is None:
+                self.open_buckets[resolution] = [start, value, value, value, 1]
+            else:
+                bucket[1] = min(bucket[1], value)
+                bucket[2] = max(bucket[2], value)
+                bucket[3] += value
+                bucket[4] += 1
+        return closed
+
+    def _oldest(self, resolution, ring):
+        bucket = self.open_buckets.get(resolution) if resolution else None
+        return min(ring.oldest(), bucket[0]) if bucket is not None else ring.oldest()
+
+    def query(self, t_from, t_to, step=0):
+        # Use the finest source that reaches back to t_from, whatever step asked for, or else the
+        # one reaching furthest back; the resolution used is reported with the points
+        sources = [(0, self.raw)] + sorted(self.rollups.items())
+        covering = [source for source in sources if self._oldest(*source) <= t_from]
+        resolution, ring = covering[0] if covering else min(sources, key=lambda source: self._oldest(*source))
+        if resolution:
+            rows = list(ring.rows(t_from, t_to))
+            bucket = self.open_buckets.get(resolution)
+            if bucket is not None and t_from <= bucket[0] <= t_to:
+                rows.append(tuple(bucket))
+        else:
+            rows = [(t, value, value, value, 1) for t, value in ring.rows(t_from, t_to)]
+
+        if step <= resolution:
+            points = [[t, total / n, low, high] for t, low, high, total, n in rows]
+        else:
+            points = []
+            for t, low, high, total, n in rows:
+                start = t - t % step
+                if points and points[-1][0] == start:
+                    point = points[-1]
+                    point[1] = min(point[1], low)
+                    point[2] = max(point[2], high)
+                    point[3] += total
+                    point[4] += n
+                else:
+                    points.append([start, low, high, total, n])
+            points = [[t, total / n, low, high] for t, low, high, total, n in points]
+        return {'resolution': resolution, 'columns': ['time', 'avg', 'min', 'max'], 'points': points}
+
+class HistoryStore:
+    """Bounded in-memory history of every numeric register, optionally spilling rollups to SQLite."""
+    def __init__(self, db_path=''):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._registers = {}  # (gateway, device, instance, register_name) -> RegisterHistory
+        self._unsaved = deque(maxlen=100000)
+
+    def record_device(self, gateway, device, instance, values, timestamp=None):
+        timestamp = timestamp or time()
+        with self._lock:
+            for register_name, value in values.items():
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    continue
+                key = (gateway, device, instance, register_name)
+                register_history = self._registers.get(key)
+                if register_history is None:
+                    register_history = self._registers[key] = RegisterHistory()
+                for resolution, bucket in register_history.record(timestamp, float(value)):
+                    if self.db_path:
+                        self._unsaved.append(key + (resolution, *bucket))
+
+    def query(self, gateway, device, instance, register_name, t_from, t_to, step=0):
+        with self._lock:
+            register_history = self._registers.get((gateway, device, instance, register_name))
+            if register_history is None:
+                return {'resolution': 0, 'columns': ['time', 'avg', 'min', 'max'], 'points': []}
+            return register_history.query(t_from, t_to, step)
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path)
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS rollups (gateway TEXT, device TEXT, instance TEXT, register TEXT, '
+            'resolution INTEGER, start REAL, min REAL, max REAL, sum REAL, count INTEGER, '
+            'PRIMARY KEY (gateway, device, instance, register, resolution, start))'
+        )
+        return db
+
+    def load(self):
+        if not self.db_path:
+            return
+        try:
+            db = self._connect()
+            now = time()
+            with self._lock:
+                for resolution, capacity in rollup_capacities.items():
+                    rows = db.execute(
+                        'SELECT gateway, device, instance, register, start, min, max, sum, count FROM rollups '
+                        'WHERE resolution = ? AND start >= ? ORDER BY start', (resolution, now - resolution * capacity)
+                    )
+                    for gateway, device, instance, register_name, *bucket in rows:
+                        key = (gateway, device, instance, register_name)
+                        if key not in self._registers:
+                            self._registers[key] = RegisterHistory()
+                        self._registers[key].rollups[resolution].append(*bucket)
+            db.close()
+            logger.info(f"Loaded history for {len(self._registers)} registers from {self.db_path}")
+        except sqlite3.Error as e:
+            logger.error(f"Failed to load history from {self.db_path}: {str(e)}")
+
+    def flush(self):
+        if not self.db_path:
+            return
+        with self._lock:
+            rows = list(self._unsaved)
+            self._unsaved.clear()
+        if not rows:
+            return
+        try:
+            db = self._connect()
+            with db:
+                db.executemany('INSERT OR REPLACE INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                now = time()
+                for resolution, capacity in rollup_capacities.items():
+                    db.execute('DELETE FROM rollups WHERE resolution = ? AND start < ?', (resolution, now - resolution * capacity))
+            db.close()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to save history to {self.db_path}: {str(e)}")
+
+history = HistoryStore(HISTORY_DB)
+
+class StreamSubscriber:
+    """One /stream client: what it asked for and a bounded queue of pending updates."""
+    def __init__(self, gateway=None, device=None, fields=None, buffer=STREAM_BUFFER):
+        self.gateway = gateway
+        self.device = device
+        self.fields = fields
+        self.events = queue.Queue(maxsize=buffer)
+        self.dropped = False
+
+    def matches(self, gateway, device):
+        return (self.gateway is None or self.gateway == gateway) and (self.device is None or self.device == device)
+
+    def select(self, values):
+        return {name: value for name, value in values.items() if not self.fields or name in self.fields}
+
+    def offer(self, event):
+        try:
+            self.events.put_nowait(event)
+            return True
+        except queue.Full:
+            self.dropped = True
+            return False
+
+class StreamHub:
+    """Fans changed register values out from the poller to /stream clients."""
+    def __init__(self, max_clients=STREAM_MAX_CLIENTS):
+        self.max_clients = max_clients
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._last = {}  # (gateway, device, instance) -> {register_name: value}
+
+    def subscribe(self, subscriber):
+        with self._lock:
+            if len(self._subscribers) >= self.max_clients:
+                return False
+            self._subscribers.append(subscriber)
+            return True
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def prune(self, keep):
+        """Drop devices whose (gateway, device, instance) is not in keep."""
+        with self._lock:
+            for key in list(self._last):
+                if key not in keep:
+                    del self._last[key]
+
+    def publish(self, gateway, device, instance, values):
+        with self._lock:
+            last = self._last.setdefault((gateway, device, instance), {})
+            changed = {name: value for name, value in values.items() if name not in last or last[name] != value}
+            last.update(changed)
+            subscribers = list(self._subscribers)
+        if not changed or not subscribers:
+            return
+        now = time()
+        for subscriber in subscribers:
+            if subscriber.dropped or not subscriber.matches(gateway, device):
+                continue
+            selected = subscriber.select(changed)
+            if not selected:
+                continue
+            event = {'gateway': gateway, 'device': device, 'instance': instance, 'time': now, 'values': selected}
+            if not subscriber.offer(event):
+                stream_dropped.inc()
+                logger.warning(f"Dropping stream client for {subscriber.gateway or 'all gateways'}; "
+                               f"more than {subscriber.events.maxsize} updates behind")
+
+stream_hub = StreamHub()
+
+# Functions allowed in derived metric expressions; wildcard references must be passed to one
+derived_functions = {
+    'sum': sum,
+    'min': min,
+    'max': max,
+    'avg': lambda values: sum(values) / len(values),
+    'abs': abs,
+    'round': round
+}
+derived_nodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load, ast.Constant,
+                 ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.USub, ast.UAdd)
+derived_reference = re.compile(r'\{([^{}]+)\}')
+
+class DerivedMetric:
+    """One derived value computed from an expression over register references.
+
+    References are written {gateway/device/instance/register}, with * matching
+    any part. A reference with a wildcard stands for the list of matching values
+    and must be passed to a function such as sum(). With integrate set, the
+    value is Riemann-summed over time in hours (left, right or trapezoidal) and
+    multiplied by scale, e.g. 0.001 to turn W into kWh.
+    """
+    __slots__ = ('name', 'expression', 'code', 'refs', 'unit', 'device_class', 'state_class', 'deadband',
+                 'integrate', 'method', 'scale', 'max_gap', 'value', 'total', 'last_time', 'last_value')
+
+    def __init__(self, spec):
+        self.name = spec['name']
+        if not re.fullmatch(r'[A-Za-z0-9_]+', self.name):
+            raise ValueError(f"Derived metric name {self.name} may only contain letters, digits and _")
+        self.expression = spec['expression']
+        self.refs = []  # [(variable, (gateway, device, instance, register))]
+
+        def substitute(match):
+            parts = tuple(part.strip() for part in match.group(1).split('/'))
+            if len(parts) != 4:
+                raise ValueError(f"Reference {{{match.group(1)}}} must be gateway/device/instance/register")
+            variable = f"_ref{len(self.refs)}"
+            self.refs.append((variable, parts))
+            return variable
+
+        tree = ast.parse(derived_reference.sub(substitute, self.expression), mode='eval')
+        variables = {variable for variable, _ in self.refs}
+        wildcards = {variable for variable, parts in self.refs if '*' in parts}
+        wildcard_args = set()
+        for node in ast.walk(tree):
+            if not isinstance(node, derived_nodes):
+                raise ValueError(f"{type(node).__name__} is not allowed in derived metric {self.name}")
+            if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+                raise ValueError(f"Only numbers are allowed as constants in derived metric {self.name}")
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in derived_functions or node.keywords:
+                    raise ValueError(f"Unsupported function call in derived metric {self.name}")
+                wildcard_args.update(arg.id for arg in node.args if isinstance(arg, ast.Name))
+            elif isinstance(node, ast.Name) and node.id not in derived_functions and node.id not in variables:
+                raise ValueError(f"Unknown name {node.id} in derived metric {self.name}; registers are written {{gateway/device/instance/register}}")
+        if wildcards - wildcard_args:
+            raise ValueError(f"Wildcard references in derived metric {self.name} must be passed to a function such as sum()")
+        self.code = compile(tree, f"<derived {self.name}>", 'eval')
+        self.unit = spec.get('unit', '')
+        self.device_class = spec.get('device_class')
+        self.state_class = spec.get('state_class')
+        self.deadband = spec.get('deadband', 0)
+        self.integrate = spec.get('integrate', False)
+        self.method = spec.get('method', 'trapezoidal')
+        if self.method not in ('left', 'right', 'trapezoidal'):
+            raise ValueError(f"Integration method of {self.name} must be left, right or trapezoidal")
+        self.scale = spec.get('scale', 1)
+        # Gaps longer than this (seconds) are not integrated across
+        self.max_gap = spec.get('max_gap', 600)
+        if self.integrate and not self.state_class:
+            self.state_class = 'total_increasing'
+        self.value = None
+        self.total = 0.0
+        self.last_time = None
+        self.last_value = None
+
+    def evaluate(self, namespace, now):
+        value = eval(self.code, {'__builtins__': {}}, namespace)
+        if not self.integrate:
+            self.value = round(value, 6) if isinstance(value, float) else value
+            return self.value
+        if self.last_time is not None and 0 < now - self.last_time <= self.max_gap:
+            hours = (now - self.last_time) / 3600
+            if self.method == 'left':
+                self.total += self.last_value * hours * self.scale
+            elif self.method == 'right':
+                self.total += value * hours * self.scale
+            else:
+                self.total += (self.last_value + value) / 2 * hours * self.scale
+        self.last_time = now
+        self.last_value = value
+        self.value = round(self.total, 6)
+        return self.value
+
+class DerivedEngine:
+    """Evaluates derived metrics as register values arrive.
+
+    Each metric is recomputed only when one of its inputs changes; integrators
+    are stepped on every new sample of an input so time keeps accumulating
+    while the value holds steady. Inputs that failed to read or are older than
+    their register's snapshot max age are left out.
+    """
+    def __init__(self, state_path=DERIVED_STATE):
+        self.state_path = state_path
+        self.specs = []
+        self.metrics = {}  # name -> DerivedMetric
+        self._inputs = {}  # (gateway, device, instance, register) -> (latest value, timestamp)
+        self._dependents = {}  # (gateway, device, instance, register) -> [metric]
+        self._bindings = {}  # name -> [(variable, [key], wildcard)]
+        self._lock = threading.Lock()
+        self._saved_totals = None
+
+    def _load_totals(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to read derived metric state {self.state_path}: {str(e)}")
+            return {}
+
+    def configure(self, specs, gateways_config):
+        """Replace the metric set and resolve references against the configured devices."""
+        metrics = {}
+        for spec in specs:
+            try:
+                metric = DerivedMetric(spec)
+            except (KeyError, TypeError, ValueError, SyntaxError) as e:
+                logger.error(f"Skipping derived metric {spec.get('name') if isinstance(spec, dict) else spec}: {str(e)}")
+                continue
+            metrics[metric.name] = metric
+
+        available = [
+            (name, device_type, device_name, register_name)
+            for name, gw_config in gateways_config.items()
+            for device_type, devices in gw_config['device_ids'].items()
+            for device_name in devices
+            for register_name in register_decoders[device_type]
+        ]
+        dependents = {}
+        bindings = {}
+        for metric in metrics.values():
+            bindings[metric.name] = []
+            for variable, parts in metric.refs:
+                keys = [key for key in available if all(part in ('*', actual) for part, actual in zip(parts, key))]
+                if not keys:
+                    logger.warning(f"Reference {'/'.join(parts)} in derived metric {metric.name} matches no configured register")
+                bindings[metric.name].append((variable, keys, '*' in parts))
+                for key in keys:
+                    dependents.setdefault(key, []).append(metric)
+
+        with self._lock:
+            if self._saved_totals is None:
+                self._saved_totals = self._load_totals()
+            # Integrators that survive a reload keep their running total
+            for metric in metrics.values():
+                previous = self.metrics.get(metric.name)
+                if previous is not None and previous.expression == metric.expression:
+                    metric.total, metric.last_time, metric.last_value = previous.total, previous.last_time, previous.last_value
+                elif metric.integrate:
+                    metric.total = self._saved_totals.get(metric.name, 0.0)
+            self.specs = specs
+            self.metrics = metrics
+            self._dependents = dependents
+            self._bindings = bindings
+
+    def _fresh_input(self, key, now):
+        value, timestamp = self._inputs.get(key, (None, 0))
+        if not isinstance(value, (int, float)) or now - timestamp > register_max_age(key[1], key[3]):
+            return None
+        return value
+
+    def _namespace(self, metric, now):
+        namespace = dict(derived_functions)
+        for variable, keys, wildcard in self._bindings[metric.name]:
+            values = [value for value in (self._fresh_input(key, now) for key in keys) if value is not None]
+            if wildcard:
+                namespace[variable] = values
+            elif values:
+                namespace[variable] = values[0]
+            else:
+                return None
+        return namespace
+
+    def update(self, gateway, device, instance, values, errors=()):
+        """Feed newly polled register values and the names of registers that failed to read.
+
+        Returns {name: value} of the metrics that were recomputed.
+        """
+        now = time()
+        results = {}
+        with self._lock:
+            affected = []
+            for register_name in errors:
+                key = (gateway, device, instance, register_name)
+                if self._inputs.pop(key, None) is not None:
+                    affected.extend(metric for metric in self._dependents.get(key, []) if metric not in affected)
+            for register_name, value in values.items():
+                key = (gateway, device, instance, register_name)
+                dependents = self._dependents.get(key)
+                if not dependents:
+                    continue
+                # An input coming back from stale counts as changed
+                changed = self._fresh_input(key, now) != value
+                self._inputs[key] = (value, now)
+                for metric in dependents:
+                    if (changed or metric.integrate) and metric not in affected:
+                        affected.append(metric)
+            for metric in affected:
+                namespace = self._namespace(metric, now)
+                if namespace is None:
+                    # Integration restarts once the inputs are back rather than bridging the gap
+                    metric.last_time = None
+                    continue
+                try:
+                    results[metric.name] = metric.evaluate(namespace, now)
+                except (ArithmeticError, TypeError, ValueError) as e:
+                    logger.debug(f"Derived metric {metric.name} could not be evaluated: {str(e)}")
+        return results
+
+    def publish(self, results):
+        for name, value in results.items():
+            metric = self.metrics.get(name)
+            topic = f"conext/derived/{name}"
+            if metric is not None and publish_filter.should_publish(topic, value, metric.deadband):
+                mqtt_publish(topic, json.dumps({"value": value}))
+
+    def values(self):
+        with self._lock:
+            return {
+                name: {'value': metric.value, 'unit': metric.unit, 'expression': metric.expression}
+                for name, metric in self.metrics.items()
+            }
+
+    def discovery(self):
+        """Return {topic: payload} of the MQTT discovery configs for the derived metrics."""
+        device_config = {
+            "name": "Conext Site",
+            "identifiers": ["conext_derived"],
+            "manufacturer": "Schneider Electric",
+            "model": "Derived"
+        }
+        discovery = {}
+        for name, metric in self.metrics.items():
+            config = {
+                "name": name.replace('_', ' ').title(),
+                "state_topic": f"conext/derived/{name}",
+                "unique_id": f"sensor.conext_derived_{name}",
+                "device": device_config,
+                "unit_of_measurement": metric.unit,
+                "value_template": "{{ value_json.value }}"
+            }
+            if metric.device_class:
+                config["device_class"] = metric.device_class
+            if metric.state_class:
+                config["state_class"] = metric.state_class
+            discovery[f"{MQTT_DISCOVERY_PREFIX}/sensor/conext_derived/{name}/config"] = json.dumps(config)
+        return discovery
+
+    def save(self):
+        if not self.state_path:
+            return
+        with self._lock:
+            totals = {name: metric.total for name, metric in self.metrics.items() if metric.integrate}
+            if self._saved_totals is not None:
+                totals = {**self._saved_totals, **totals}
+                self._saved_totals = totals
+        try:
+            with open(self.state_path, 'w') as f:
+                json.dump(totals, f)
+        except OSError as e:
+            logger.error(f"Failed to save derived metric state {self.state_path}: {str(e)}")
+
+derived = DerivedEngine()
+
+def read_derived_file(derived_path=DERIVED_PATH):
+    """Return the list of derived metric specs, or None if the file could not be parsed."""
+    if not os.path.exists(derived_path):
+        return []
+    try:
+        with open(derived_path, 'r') as f:
+            specs = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to load derived metrics from {derived_path}: {str(e)}")
+        return None
+    # The add-on option may hold the JSON as a string
+    if isinstance(specs, str):
+        try:
+            specs = json.loads(specs) if specs.strip() else []
+        except ValueError as e:
+            logger.error(f"Failed to parse derived metrics: {str(e)}")
+            return None
+    if not isinstance(specs, list):
+        logger.error("Derived metrics must be a JSON list")
+        return None
+    return specs
+
+# Background thread to persist history rollups and integrator totals
+def save_history():
+    history.load()
+    while True:
+        sleep(60)
+        history.flush()
+        derived.save()
+
+def get_modbus_values(gateway, device, device_instance=None, publish=True, interval=None):
+    logger.debug(f"Querying {gateway}/{device}/{device_instance}")
     if gateway not in gateways:
         return {'error': f'Gateway {gateway} not found'}, 404
     gw_config = gateways[gateway]
-    host = gw_config['ip']
-    port = gw_config['port']
-    timeout = gw_config['timeout']
+    pool = get_pool(gateway)
     devices = gw_config['device_ids'].get(device, {})
-    register_data = registers_data.get(device, {})
     return_data = {}
 
     if not devices:
         return {'error': f'No {device} devices configured for gateway {gateway}'}, 404
 
+    gateway_breaker = get_breaker(gateway, failure_threshold=3)
     for device_key in devices:
         if device_instance and device_instance != device_key:
             continue
-        
-        # Skip if device has failed repeatedly
+
         device_id = f"{gateway}_{device}_{device_key}"
-        if device_id in failed_devices and failed_devices[device_id] >= 5:
-            logger.debug(f"Skipping {device_id} due to repeated failures")
-            return_data[device_key] = {"error": f"Device {device_key} skipped due to repeated failures"}
+        device_breaker = get_breaker(device_id)
+        if not gateway_breaker.allow():
+            logger.debug(f"Skipping {device_id}; gateway circuit open")
+            return_data[device_key] = {"error": f"Gateway {gateway} circuit open"}
+            continue
+        if not device_breaker.allow():
+            logger.debug(f"Skipping {device_id}; circuit open")
+            return_data[device_key] = {"error": f"Device {device_key} circuit open"}
             continue
 
         return_data[device_key] = {}
-        for register_name in register_data:
-            register_data_values = register_data[register_name].split(',')
-            register = int(register_data_values[0])
-            reg_len = int(register_data_values[1])
-            extra = float(register_data_values[2])
+        responded = False
+        connection_failed = False
+        failure = None
+        for block in get_read_plan(device, gw_config['max_register_gap'], interval):
+            if failure is not None:
+                # The device already timed out this poll; fail the rest without waiting on it again
+                block_values = {decoder.name: failure for decoder, _ in block.registers}
+            else:
+                try:
+                    started = monotonic()
+                    block_values = read_block(pool, devices[device_key], block)
+                    modbus_read_seconds.labels(gateway, device).observe(monotonic() - started)
+                    responded = True
+                    for value in block_values.values():
+                        if isinstance(value, Exception):
+                            modbus_read_errors.labels(gateway, device, read_error_type(value)).inc()
+                except ModbusExceptionError as e:
+                    block_values = {decoder.name: e for decoder, _ in block.registers}
+                    responded = True
+                    modbus_read_errors.labels(gateway, device, read_error_type(e)).inc()
+                except Exception as e:
+                    block_values = {decoder.name: e for decoder, _ in block.registers}
+                    connection_failed = isinstance(e, ConnectionError)
+                    failure = e
+                    modbus_read_errors.labels(gateway, device, read_error_type(e)).inc()
+            for decoder, _ in block.registers:
+                register_name = decoder.name
+                try:
+                    hold_reg_arr = block_values[register_name]
+                    if isinstance(hold_reg_arr, Exception):
+                        raise hold_reg_arr
 
-            try:
-                cxt = ModbusClient(host=host, port=port, auto_open=True, auto_close=True, unit_id=devices[device_key], timeout=timeout)
-                if not cxt.is_open:
-                    raise ValueError(f"Failed to connect to {host}:{port} with unit_id {devices[device_key]}")
-                hold_reg_arr = cxt.read_holding_registers(register, reg_len)
-
-                if hold_reg_arr is None:
-                    raise ValueError(f"No data returned from register {register} for {device_key}")
-                
-                # Reset failure count on success
-                if device_id in failed_devices:
-                    del failed_devices[device_id]
-
-                if reg_len == 2:
-                    if hold_reg_arr[0] == 65535:
-                        converted_value = hold_reg_arr[1] - hold_reg_arr[0]
-                    elif hold_reg_arr[0] > 0 and hold_reg_arr[0] < 50:
-                        converted_value = hold_reg_arr[0] * 65536 + hold_reg_arr[1]
-                    elif register in [130, 166]:
-                        converted_value = hold_reg_arr[0]
-                    else:
-                        converted_value = hold_reg_arr[1]
-                elif reg_len == 4:
-                    converted_value = (hold_reg_arr[0] << 48) + (hold_reg_arr[1] << 32) + (hold_reg_arr[2] << 16) + hold_reg_arr[3]
-                elif reg_len == 8:
-                    string_chars = ""
-                    for a in hold_reg_arr:
-                        if a > 0:
-                            hex_string = hex(a)[2:]
-                            if hex_string.endswith("00"):
-                                hex_string = hex_string[:len(hex_string) - 2]
-                            bytes_object = bytes.fromhex(hex_string)
-                            string_chars += bytes_object.decode("ASCII")
-                    converted_value = string_chars
-                else:
-                    converted_value = hold_reg_arr[0]
-
-                if device == "battery":
-                    if register == 70:
-                        converted_value /= extra
-                    elif register == 74:
-                        converted_value = converted_value * 0.01 + extra
-                    elif register in [76, 88]:
-                        converted_value = converted_value
-                    else:
-                        converted_value = converted_value
-
-                if device == "powermeter":
-                    converted_value *= extra  # Scale for power, voltage, current, energy
-
-                if device == "inverter":
-                    if register == 64:
-                        converted_value = operating_state.get(converted_value, 'Unknown')
-                    elif register == 122:
-                        converted_value = inverter_status.get(converted_value, 'Unknown')
-                    elif register in [120, 132, 154, 170, 172]:
-                        converted_value = converted_value
-                    elif register in [126, 130, 142, 144, 146, 148, 162, 166, 178, 180, 182, 184]:
-                        converted_value /= extra
-                    else:
-                        converted_value = converted_value
-
-                if device == "cc":
-                    if register == 64:
-                        converted_value = operating_state.get(converted_value, 'Unknown')
-                    elif register == 73:
-                        converted_value = cc_status.get(converted_value, 'Unknown')
-                    elif register == 68:
-                        converted_value = "Has Active Faults" if converted_value == 1 else "No Active Faults"
-                    elif register == 69:
-                        converted_value = "Has Active Warnings" if converted_value == 1 else "No Active Warnings"
-                    elif register in [76, 78, 88, 90]:
-                        converted_value /= extra
-                    elif register in [80, 92]:
-                        converted_value = converted_value
-                    elif register == 249:
-                        converted_value = solar_association.get(converted_value, 'Unknown')
-                    else:
-                        converted_value = converted_value
-
-                if device == "ags":
-                    if register == 64:
-                        converted_value = operating_state.get(converted_value, 'Unknown')
-                    elif register == 70:
-                        converted_value = ags_state.get(converted_value, 'Unknown')
-                    elif register in [68, 69, 72]:
-                        converted_value = converted_value
-                    else:
-                        converted_value = converted_value
-
-                if device == "scp":
-                    if register == 64:
-                        converted_value = operating_state.get(converted_value, 'Unknown')
-                    elif register == 70:
-                        converted_value = scp_status.get(converted_value, 'Unknown')
-                    elif register in [68, 69]:
-                        converted_value = converted_value
-                    else:
-                        converted_value = converted_value
-
-                if device == "gridtie":
-                    if register == 64:
-                        converted_value = operating_state.get(converted_value, 'Unknown')
-                    elif register in [76, 88]:
-                        converted_value /= extra
-                    elif register in [68, 69]:
-                        converted_value = converted_value
-                    else:
-                        converted_value = converted_value
-
-                return_data[device_key][register_name] = converted_value
-                # Publish to MQTT
-                mqtt_topic = f"conext/{gateway}/{device}/{device_key}/{register_name}"
-                mqtt_payload = {"value": converted_value}
-                mqtt_client.publish(mqtt_topic, json.dumps(mqtt_payload))
-            except Exception as e:
-                logger.error(f"Error querying {gateway}/{device}/{device_key}/{register_name}: {str(e)}")
-                return_data[device_key][register_name] = {"error": str(e)}
-                # Track failures
-                failed_devices[device_id] = failed_devices.get(device_id, 0) + 1
-                # Publish error to MQTT
-                mqtt_topic = f"conext/{gateway}/{device}/{device_key}/{register_name}"
-                mqtt_payload = {"value": str(e)}
-                mqtt_client.publish(mqtt_topic, json.dumps(mqtt_payload))
-            sleep(0.1)
+                    converted_value = decoder.decode(hold_reg_arr)
+                    return_data[device_key][register_name] = converted_value
+                    mqtt_topic = f"conext/{gateway}/{device}/{device_key}/{register_name}"
+                    if publish and not MQTT_AGGREGATE and publish_filter.should_publish(mqtt_topic, converted_value, decoder.deadband, decoder.deadband_pct):
+                        # Publish to MQTT
+                        mqtt_payload = {"value": converted_value}
+                        mqtt_publish(mqtt_topic, json.dumps(mqtt_payload))
+                except Exception as e:
+                    logger.error(f"Error querying {gateway}/{device}/{device_key}/{register_name}: {str(e)}")
+                    if not isinstance(block_values[register_name], Exception):
+                        modbus_read_errors.labels(gateway, device, 'decode').inc()
+                    return_data[device_key][register_name] = {"error": str(e)}
+                    mqtt_topic = f"conext/{gateway}/{device}/{device_key}/{register_name}"
+                    if publish and not MQTT_AGGREGATE and publish_filter.should_publish(mqtt_topic, str(e)):
+                        # Publish error to MQTT
+                        mqtt_payload = {"value": str(e)}
+                        mqtt_publish(mqtt_topic, json.dumps(mqtt_payload))
+
+        if responded:
+            device_breaker.record_success()
+        else:
+            device_breaker.record_failure()
+        # A device timing out still means the gateway itself accepted the connection
+        if connection_failed:
+            gateway_breaker.record_failure()
+        else:
+            gateway_breaker.record_success()
+
+        # Errors are kept apart so the last good values keep serving until they age out
+        polled_values = {
+            register_name: value for register_name, value in return_data[device_key].items()
+            if not (isinstance(value, dict) and 'error' in value)
+        }
+        polled_errors = {
+            register_name: value['error'] for register_name, value in return_data[device_key].items()
+            if register_name not in polled_values
+        }
+        snapshot.update(gateway, device, device_key, polled_values, polled_errors)
+        history.record_device(gateway, device, device_key, polled_values)
+        # Live REST reads don't publish, so they also leave derived metrics to the poller;
+        # inputs they changed would otherwise never be published
+        if publish:
+            derived.publish(derived.update(gateway, device, device_key, polled_values, polled_errors))
+        stream_hub.publish(gateway, device, device_key, polled_values)
+        if publish and MQTT_AGGREGATE:
+            publish_device_state(gateway, device, device_key, return_data[device_key])
     
     return return_data, 200 if return_data else ({'error': 'No data returned'}, 404)
 
+# Control writes; finished commands are kept for status lookups until COMMAND_HISTORY is exceeded
+COMMAND_HISTORY = 1000
+# Longest a poll waits between devices for queued writes, so bursts of commands can't stall telemetry
+COMMAND_POLL_DEFER = 2
+commands = {}  # id -> command, oldest first
+commands_lock = threading.Lock()
+
+def new_command(gateway, device, instance, register_name, value):
+    now = time()
+    command = {
+        'id': uuid.uuid4().hex,
+        'gateway': gateway,
+        'device': device,
+        'instance': instance,
+        'register': register_name,
+        'value': value,
+        'status': 'queued',
+        'created': now,
+        'updated': now
+    }
+    with commands_lock:
+        commands[command['id']] = command
+        while len(commands) > COMMAND_HISTORY:
+            del commands[next(iter(commands))]
+    return command
+
+def update_command(command, status, **fields):
+    with commands_lock:
+        command.update(status=status, updated=time(), **fields)
+    if status in ('done', 'failed', 'superseded'):
+        control_commands.labels(status).inc()
+
+def get_command(command_id):
+    with commands_lock:
+        command = commands.get(command_id)
+        return dict(command) if command else None
+
+def execute_command(command):
+    gateway, device, instance, register_name = command['gateway'], command['device'], command['instance'], command['register']
+    unit_id = gateways.get(gateway, {}).get('device_ids', {}).get(device, {}).get(instance)
+    if unit_id is None:
+        update_command(command, 'failed', error=f"Device {instance} is no longer configured")
+        return
+    if not get_breaker(gateway, failure_threshold=3).allow():
+        update_command(command, 'failed', error=f"Gateway {gateway} circuit open")
+        return
+    decoder = register_decoders[device][register_name]
+    words = decoder.encode(command['value'])
+    update_command(command, 'running')
+    pool = get_pool(gateway)
+    try:
+        pool.write_registers(unit_id, decoder.register, words)
+        read_back = decoder.decode(pool.read_holding_registers(unit_id, decoder.register, decoder.length))
+    except (ConnectionError, ValueError) as e:
+        logger.error(f"Write of {register_name}={command['value']} to {gateway}/{device}/{instance} failed: {str(e)}")
+        update_command(command, 'failed', error=str(e))
+        return
+    expected = decoder.decode(words)
+    if read_back != expected:
+        logger.error(f"Write of {register_name} to {gateway}/{device}/{instance} read back {read_back} instead of {expected}")
+        update_command(command, 'failed', error=f"Read back {read_back} instead of {expected}", read_back=read_back)
+        return
+    snapshot.update(gateway, device, instance, {register_name: read_back})
+    logger.info(f"Set {gateway}/{device}/{instance} {register_name} to {read_back}")
+    update_command(command, 'done', read_back=read_back)
+
+class CommandQueue:
+    """Runs control writes to one gateway one at a time, ahead of polling.
+
+    A write to a register that already has a write queued replaces it, and the
+    replaced command is marked superseded. Each write is read back and compared
+    with the value that was sent.
+    """
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self._cond = threading.Condition()
+        self._pending = {}  # (device, instance, register_name) -> command, in queue order
+        self._busy = False
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, command):
+        key = (command['device'], command['instance'], command['register'])
+        with self._cond:
+            queued = self._pending.pop(key, None)
+            self._pending[key] = command
+            self._cond.notify_all()
+        if queued is not None:
+            update_command(queued, 'superseded', superseded_by=command['id'])
+
+    def wait_idle(self, timeout):
+        """Wait until no write is queued or running, for at most timeout seconds."""
+        with self._cond:
+            self._cond.wait_for(lambda: not self._pending and not self._busy, timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+                command = self._pending.pop(next(iter(self._pending)))
+                self._busy = True
+            try:
+                execute_command(command)
+            except Exception as e:
+                logger.error(f"Error running command {command['id']}: {str(e)}")
+                update_command(command, 'failed', error=str(e))
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+command_queues = {}
+command_queues_lock = threading.Lock()
+
+def get_command_queue(gateway):
+    with command_queues_lock:
+        if gateway not in command_queues:
+            command_queues[gateway] = CommandQueue(gateway)
+        return command_queues[gateway]
+
+def set_device_values(gateway, device, device_instance=None):
+    """Queue writes from a JSON object of {register: value}; returns 202 with the queued commands."""
+    if gateway not in gateways:
+        return {'error': f'Gateway {gateway} not found'}, 404
+    devices = gateways[gateway]['device_ids'].get(device, {})
+    if device_instance not in devices:
+        return {'error': f'Device {device_instance} not found for gateway {gateway}'}, 404
+    writable = {name: decoder for name, decoder in register_decoders[device].items() if decoder.writable}
+    settings = request.get_json(silent=True)
+    if not isinstance(settings, dict) or not settings:
+        return {'error': 'Expected a JSON object of {register: value}', 'writable': list(writable)}, 400
+    # Every value is checked before any is queued, so a bad request changes nothing
+    for register_name, value in settings.items():
+        if register_name not in writable:
+            return {'error': f'{register_name} is not writable', 'writable': list(writable)}, 400
+        try:
+            writable[register_name].encode(value)
+        except ValueError as e:
+            return {'error': str(e)}, 400
+    command_queue = get_command_queue(gateway)
+    queued = []
+    for register_name, value in settings.items():
+        command = new_command(gateway, device, device_instance, register_name, value)
+        command_queue.submit(command)
+        queued.append(command['id'])
+    return {'commands': [get_command(command_id) for command_id in queued]}, 202
+
+def get_device_values(gateway, device, device_instance=None):
+    """Serve a REST read from the snapshot, falling back to a live read when stale or ?fresh=1."""
+    if gateway not in gateways:
+        return {'error': f'Gateway {gateway} not found'}, 404
+    devices = gateways[gateway]['device_ids'].get(device, {})
+    if not devices:
+        return {'error': f'No {device} devices configured for gateway {gateway}'}, 404
+    if device_instance and device_instance not in devices:
+        return {'error': f'Device {device_instance} not found for gateway {gateway}'}, 404
+
+    if requested_fresh():
+        rest_cache_requests.labels(device, 'bypass').inc()
+    else:
+        return_data = {}
+        oldest = None
+        for device_key in devices:
+            if device_instance and device_instance != device_key:
+                continue
+            cached = snapshot.get(gateway, device, device_key)
+            if cached is None:
+                rest_cache_requests.labels(device, 'miss').inc()
+                break
+            return_data[device_key], timestamp = cached
+            oldest = timestamp if oldest is None else min(oldest, timestamp)
+        else:
+            rest_cache_requests.labels(device, 'hit').inc()
+            return return_data, 200, {'Age': str(int(time() - oldest)), 'Last-Modified': formatdate(oldest, usegmt=True)}
+
+    result = live_reads.do((gateway, device, device_instance), lambda: get_modbus_values(gateway, device, device_instance, publish=False))
+    if not isinstance(result, tuple):
+        return result, 500
+    return result[0], result[1], {'Age': '0', 'Last-Modified': formatdate(usegmt=True)}
+
 class Battery(Resource):
     def get(self, gateway, instance=None):
-        result = get_modbus_values(gateway, "battery", instance)
-        return result if isinstance(result, tuple) else (result, 500)
+        return get_device_values(gateway, "battery", instance)
 
 class PowerMeter(Resource):
     def get(self, gateway, instance=None):
-        result = get_modbus_values(gateway, "powermeter", instance)
-        return result if isinstance(result, tuple) else (result, 500)
+        return get_device_values(gateway, "powermeter", instance)
 
 class Inverter(Resource):
     def get(self, gateway, instance=None):
-        result = get_modbus_values(gateway, "inverter", instance)
-        return result if isinstance(result, tuple) else (result, 500)
+        return get_device_values(gateway, "inverter", instance)
 
-    def put(self, gateway, instance):
-        return {"command": f"received for gateway: {gateway} instance: {instance}"}, 200
+    def put(self, gateway, instance=None):
+        return set_device_values(gateway, "inverter", instance)
 
 class CC(Resource):
     def get(self, gateway, instance=None):
-        result = get_modbus_values(gateway, "cc", instance)
-        return result if isinstance(result, tuple) else (result, 500)
+        return get_device_values(gateway, "cc", instance)
 
-    def put(self, gateway, instance):
-        return {"command": f"received for gateway: {gateway} instance: {instance}"}, 200
+    def put(self, gateway, instance=None):
+        return set_device_values(gateway, "cc", instance)
 
 class AGS(Resource):
     def get(self, gateway, instance=None):
-        result = get_modbus_values(gateway, "ags", instance)
-        return result if isinstance(result, tuple) else (result, 500)
+        return get_device_values(gateway, "ags", instance)
 
-    def put(self, gateway, instance):
-        return {"command": f"received for gateway: {gateway} instance: {instance}"}, 200
+    def put(self, gateway, instance=None):
+        return set_device_values(gateway, "ags", instance)
 
 class SCP(Resource):
     def get(self, gateway, instance=None):
-        result = get_modbus_values(gateway, "scp", instance)
-        return result if isinstance(result, tuple) else (result, 500)
+        return get_device_values(gateway, "scp", instance)
 
-    def put(self, gateway, instance):
-        return {"command": f"received for gateway: {gateway} instance: {instance}"}, 200
+    def put(self, gateway, instance=None):
+        return set_device_values(gateway, "scp", instance)
 
 class GridTie(Resource):
     def get(self, gateway, instance=None):
-        result = get_modbus_values(gateway, "gridtie", instance)
-        return result if isinstance(result, tuple) else (result, 500)
+        return get_device_values(gateway, "gridtie", instance)
 
-    def put(self, gateway, instance):
-        return {"command": f"received for gateway: {gateway} instance: {instance}"}, 200
+    def put(self, gateway, instance=None):
+        return set_device_values(gateway, "gridtie", instance)
 
 class Index(Resource):
     def get(self):
         logger.info(f"Root endpoint accessed, gateways: {list(gateways.keys())}")
-        return {"message": "Solar monitor API", "gateways": list(gateways.keys())}, 200
+        return {"message": "Solar monitor API", "gateways": list(gateways.keys()), "poll": poll_stats, "mqtt": publish_filter.stats()}, 200
+
+def parse_time(value, default):
+    # Unix seconds or an ISO 8601 timestamp
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+class History(Resource):
+    def get(self, gateway, device, instance):
+        if gateway not in gateways:
+            return {'error': f'Gateway {gateway} not found'}, 404
+        if instance not in gateways[gateway]['device_ids'].get(device, {}):
+            return {'error': f'Device {instance} not found for gateway {gateway}'}, 404
+        numeric_registers = [
+            register_name for register_name, decoder in register_decoders[device].items()
+            if decoder.enum is None and decoder.number is not None
+        ]
+        register_names = [name for name in request.args.get('register', '').split(',') if name] or numeric_registers
+        unknown = [name for name in register_names if name not in numeric_registers]
+        if unknown:
+            return {'error': f'No history for {device} registers: {", ".join(unknown)}'}, 400
+        now = time()
+        try:
+            t_from = parse_time(request.args.get('from'), now - 3600)
+            t_to = parse_time(request.args.get('to'), now)
+            step = float(request.args.get('step', 0))
+        except ValueError as e:
+            return {'error': f'Invalid history query: {str(e)}'}, 400
+        return {
+            'from': t_from,
+            'to': t_to,
+            'step': step,
+            'registers': {name: history.query(gateway, device, instance, name, t_from, t_to, step) for name in register_names}
+        }, 200
+
+def collect_gateway(gateway, fields=None, fresh=False):
+    """Return ({device_type: {instance: values}}, oldest timestamp) for every device on a gateway."""
+    data = {}
+    oldest = None
+    for device_type, devices in gateways[gateway]['device_ids'].items():
+        if not devices:
+            continue
+        if fresh:
+            # The live read refreshes the snapshot, which is then read below
+            live_reads.do((gateway, device_type, None), lambda: get_modbus_values(gateway, device_type, None, publish=False))
+        data[device_type] = {}
+        for device_key in devices:
+            latest = snapshot.latest(gateway, device_type, device_key)
+            values = {}
+            if latest is not None:
+                values, timestamp = latest
+                oldest = timestamp if oldest is None else min(oldest, timestamp)
+            if fields:
+                values = {register_name: value for register_name, value in values.items() if register_name in fields}
+            data[device_type][device_key] = values
+    return data, oldest
+
+def bulk_response(data, oldest):
+    """Encode a bulk snapshot as JSON or msgpack, gzip it if accepted and honour If-None-Match."""
+    wants_msgpack = request.args.get('format') == 'msgpack' or \
+        request.accept_mimetypes.best_match(['application/json', 'application/msgpack']) == 'application/msgpack'
+    if wants_msgpack and msgpack is None:
+        return {'error': 'msgpack encoding is not available'}, 406
+    if wants_msgpack:
+        body, content_type = msgpack.packb(data), 'application/msgpack'
+    else:
+        body, content_type = json.dumps(data, separators=(',', ':')).encode(), 'application/json'
+    etag = hashlib.sha1(body).hexdigest()
+    headers = {'Vary': 'Accept, Accept-Encoding', 'Cache-Control': 'no-cache'}
+    if oldest is not None:
+        headers['Age'] = str(int(time() - oldest))
+        headers['Last-Modified'] = formatdate(oldest, usegmt=True)
+    if len(body) > 1024 and request.accept_encodings['gzip']:
+        body = gzip.compress(body, compresslevel=5)
+        headers['Content-Encoding'] = 'gzip'
+        etag += '-gzip'
+    headers['ETag'] = f'"{etag}"'
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    return Response(body, content_type=content_type, headers=headers)
+
+def fetch_owner_gateway(gateway, fields=None, fresh=False):
+    """Fetch a gateway's bulk snapshot from the cluster node that polls it."""
+    owner = cluster.owner(gateway)
+    url = cluster.url_of(owner)
+    if not url:
+        return {'error': f'No URL known for node {owner}, which polls {gateway}'}, None
+    query = urlencode({key: value for key, value in (('fields', ','.join(sorted(fields or ()))), ('fresh', '1' if fresh else '')) if value})
+    try:
+        with urlopen(Request(f"{url}/{quote(gateway)}/all" + (f"?{query}" if query else ''), headers={'Accept': 'application/json'}),
+                     timeout=CLUSTER_PROXY_TIMEOUT) as response:
+            data = json.load(response)
+            age = response.headers.get('Age')
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to fetch {gateway} from node {owner}: {str(e)}")
+        return {'error': f'Failed to fetch {gateway} from node {owner}: {str(e)}'}, None
+    return data, time() - float(age) if age else None
+
+def collect_any_gateway(gateway, fields=None, fresh=False):
+    # In cluster mode other nodes' gateways come from their snapshots
+    if cluster is not None and not cluster.owns(gateway):
+        return fetch_owner_gateway(gateway, fields, fresh)
+    return collect_gateway(gateway, fields, fresh)
+
+def requested_fields():
+    return {name for name in request.args.get('fields', '').split(',') if name}
+
+def requested_fresh():
+    return request.args.get('fresh', '').lower() in ('1', 'true', 'yes')
+
+class GatewayAll(Resource):
+    def get(self, gateway):
+        if gateway not in gateways:
+            return {'error': f'Gateway {gateway} not found'}, 404
+        data, oldest = collect_gateway(gateway, requested_fields(), requested_fresh())
+        return bulk_response(data, oldest)
+
+class All(Resource):
+    def get(self):
+        fields = requested_fields()
+        fresh = requested_fresh()
+        names = list(gateways)
+        # A fresh read polls every gateway at once, as the poller does; cluster nodes are asked in parallel too
+        results = rest_executor.map(lambda gateway: collect_any_gateway(gateway, fields, fresh), names) if fresh or cluster is not None else \
+            (collect_gateway(gateway, fields) for gateway in names)
+        data = {}
+        oldest = None
+        for gateway, (gateway_data, gateway_oldest) in zip(names, results):
+            data[gateway] = gateway_data
+            if gateway_oldest is not None:
+                oldest = gateway_oldest if oldest is None else min(oldest, gateway_oldest)
+        return bulk_response(data, oldest)
+
+class Command(Resource):
+    def get(self, command_id):
+        command = get_command(command_id)
+        if command is None:
+            return {'error': f'Command {command_id} not found'}, 404
+        return command, 200
+
+class Metrics(Resource):
+    def get(self):
+        return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
+class Scan(Resource):
+    """Returns the gateway config with device lists filled in from unit-ID scans, which run in the background."""
+    def scan(self, refresh):
+        gateways_config = read_config_file() or []
+        gateway = request.args.get('gateway')
+        result = []
+        for gw in gateways_config:
+            if not isinstance(gw, dict) or 'name' not in gw or 'ip' not in gw:
+                continue
+            if gateway and gw['name'] != gateway:
+                continue
+            merged, stale = with_scanned_devices(gw)
+            key = f"{gw['ip']}:{gw.get('port', 503)}"
+            if refresh or stale:
+                # Scans go through the gateway's polling pool, so it has to be loaded
+                loaded = gateways.get(gw['name'])
+                if loaded is not None and (loaded['ip'], loaded['port']) == (gw['ip'], gw.get('port', 503)):
+                    start_scan(gw['name'])
+                else:
+                    merged['error'] = 'Gateway is not loaded; reload the configuration before scanning it'
+            with scan_lock:
+                if key in scans_running:
+                    merged['scanning'] = True
+                elif key in scan_errors and 'error' not in merged:
+                    merged['error'] = scan_errors[key]
+            result.append(merged)
+        if gateway and not result:
+            return {'error': f"Gateway {gateway} not found"}, 404
+        return result, 202 if any(gw.get('scanning') for gw in result) else 200
+
+    def get(self):
+        return self.scan(refresh=False)
+
+    def post(self):
+        return self.scan(refresh=True)
+
+class Reload(Resource):
+    def post(self):
+        # A JSON list of gateway configs in the body replaces the config file before reloading
+        if request.content_length:
+            gateways_config = request.get_json(silent=True)
+            if not isinstance(gateways_config, list) or not all(isinstance(gw, dict) and 'name' in gw for gw in gateways_config):
+                return {'error': 'Expected a JSON list of gateway configs, each with a name'}, 400
+            try:
+                write_config_file(gateways_config)
+            except OSError as e:
+                return {'error': f'Failed to write {CONFIG_PATH}: {str(e)}'}, 500
+        result = load_config()
+        return result, 500 if 'error' in result else 200
+
+def stream_event(event_type, data):
+    return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+class Stream(Resource):
+    """Server-Sent Events of changed values as the poller reads them.
+
+    ?gateway= and ?device= restrict the stream to one gateway or device type and
+    ?fields= to a comma-separated list of registers. The current values are sent
+    first, then only changes.
+    """
+    def get(self):
+        gateway = request.args.get('gateway') or None
+        device = request.args.get('device') or None
+        if gateway and gateway not in gateways:
+            return {'error': f'Gateway {gateway} not found'}, 404
+        if device and device not in registers_data:
+            return {'error': f'Unknown device type {device}'}, 404
+        subscriber = StreamSubscriber(gateway, device, requested_fields())
+        if not stream_hub.subscribe(subscriber):
+            return {'error': f'Too many stream clients (max {STREAM_MAX_CLIENTS})'}, 503
+        initial = []
+        for name, gw_config in gateways.items():
+            for device_type, devices in gw_config['device_ids'].items():
+                if not subscriber.matches(name, device_type):
+                    continue
+                for device_name in devices:
+                    values = subscriber.select(snapshot.values(name, device_type, device_name))
+                    if values:
+                        initial.append({'gateway': name, 'device': device_type, 'instance': device_name, 'time': time(), 'values': values})
+
+        def events():
+            try:
+                for event in initial:
+                    yield stream_event('update', event)
+                while True:
+                    if subscriber.dropped:
+                        yield stream_event('dropped', {'error': 'Client fell too far behind'})
+                        return
+                    try:
+                        event = subscriber.events.get(timeout=STREAM_KEEPALIVE)
+                    except queue.Empty:
+                        # Keeps proxies from closing an idle stream and notices clients that went away
+                        yield ': keepalive\n\n'
+                        continue
+                    yield stream_event('update', event)
+            finally:
+                stream_hub.unsubscribe(subscriber)
+
+        return Response(events(), content_type='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+class ClusterStatus(Resource):
+    def get(self):
+        if cluster is None:
+            return {'error': 'Cluster mode is not enabled'}, 404
+        return cluster.status(), 200
+
+# In cluster mode, requests for a gateway another node polls are redirected to that node
+@app.before_request
+def route_to_owner():
+    if cluster is None:
+        return None
+    gateway = (request.view_args or {}).get('gateway')
+    if gateway is None and request.path == '/stream':
+        gateway = request.args.get('gateway')
+    if not gateway or gateway not in gateways or cluster.owns(gateway):
+        return None
+    owner = cluster.owner(gateway)
+    url = cluster.url_of(owner)
+    if not url:
+        return {'error': f'No URL known for node {owner}, which polls {gateway}'}, 503
+    query = request.query_string.decode()
+    # 307 keeps the method and body, so PUT commands follow the redirect too
+    return redirect(f"{url}{request.path}" + (f"?{query}" if query else ''), code=307)
+
+class Derived(Resource):
+    def get(self):
+        if cluster is not None:
+            return {'error': 'Derived metrics are not available in cluster mode'}, 404
+        return derived.values(), 200
+
+class Breakers(Resource):
+    def get(self):
+        with breakers_lock:
+            return {name: breaker.status() for name, breaker in breakers.items()}, 200
 
 # Updated routes
 api.add_resource(Battery, "/<string:gateway>/battery", "/<string:gateway>/battery/<string:instance>")
@@ -505,28 +2726,152 @@ api.add_resource(CC, "/<string:gateway>/cc", "/<string:gateway>/cc/<string:insta
 api.add_resource(AGS, "/<string:gateway>/ags", "/<string:gateway>/ags/<string:instance>")
 api.add_resource(SCP, "/<string:gateway>/scp", "/<string:gateway>/scp/<string:instance>")
 api.add_resource(GridTie, "/<string:gateway>/gridtie", "/<string:gateway>/gridtie/<string:instance>")
+api.add_resource(GatewayAll, "/<string:gateway>/all")
+api.add_resource(All, "/all")
+api.add_resource(History, "/<string:gateway>/<string:device>/<string:instance>/history")
+api.add_resource(Command, "/commands/<string:command_id>")
+api.add_resource(Derived, "/derived")
+api.add_resource(ClusterStatus, "/cluster")
+api.add_resource(Stream, "/stream")
+api.add_resource(Breakers, "/breakers")
+api.add_resource(Reload, "/reload")
+api.add_resource(Scan, "/scan")
+api.add_resource(Metrics, "/metrics")
 api.add_resource(Index, "/")
 
+# Gateways are polled in parallel; each gateway's due reads are issued in turn
+poll_executor = ThreadPoolExecutor(max_workers=POLL_WORKERS, thread_name_prefix='poll')
+
+# Fresh /all reads and fetches from other cluster nodes can block for a gateway or proxy
+# timeout, so they get their own threads rather than holding up the poller's
+rest_executor = ThreadPoolExecutor(max_workers=HTTP_THREADS, thread_name_prefix='rest')
+
+# Timing of the most recent poll run per gateway
+poll_stats = {'runs': 0, 'gateways': {}}
+
+PollJob = namedtuple('PollJob', ['gateway', 'device_type', 'device_name', 'interval'])
+
+def build_poll_jobs():
+    # In cluster mode each node polls only the gateways the ring assigns to it
+    return {
+        PollJob(gateway, device_type, device_name, interval)
+        for gateway in list(gateways)
+        if cluster is None or cluster.owns(gateway)
+        for device_type, devices in gateways[gateway]['device_ids'].items()
+        for device_name in devices
+        for interval in device_intervals(device_type)
+    }
+
+def poll_gateway(gateway, jobs):
+    # Shortest intervals carry the highest priority
+    start = monotonic()
+    lag = max(start - due for due in jobs.values())
+    polled = 0
+    command_queue = command_queues.get(gateway)
+    for job in sorted(jobs, key=lambda job: job.interval):
+        # Queued control writes go out before the next device is read
+        if command_queue is not None:
+            command_queue.wait_idle(COMMAND_POLL_DEFER)
+        get_modbus_values(gateway, job.device_type, job.device_name, interval=job.interval)
+        polled += 1
+    return polled, monotonic() - start, lag
+
 # Background thread to periodically update MQTT
 def update_mqtt():
+    if cluster is not None:
+        cluster.settled.wait(cluster.lease)
+    schedule = []  # heap of (due, interval, seq, job)
+    live = {}  # job -> seq of its current heap entry; entries with any other seq are stale
+    seq = count()
+    pending = {}  # gateway -> {job: due}
+    running = {}  # gateway -> future
+    idle = False
     while True:
-        has_devices = False
-        for gateway in gateways:
-            for device_type in gateways[gateway]['device_ids']:
-                for device_name in gateways[gateway]['device_ids'][device_type]:
-                    device_id = f"{gateway}_{device_type}_{device_name}"
-                    if device_id in failed_devices and failed_devices[device_id] >= 5:
-                        logger.debug(f"Skipping {device_id} due to repeated failures")
-                        continue
-                    get_modbus_values(gateway, device_type, device_name)
-                    has_devices = True
-        if not has_devices:
-            logger.info("No devices configured or all failed; skipping MQTT update")
-            sleep(60)  # Wait longer if no devices
-            continue
-        sleep(10)  # Update every 10 seconds
+        now = monotonic()
+        jobs = build_poll_jobs()
+        # With nothing to poll the loop keeps ticking, so gateways taken over from a dead
+        # cluster node or added by a reload are picked up within a tick
+        if not jobs and not idle:
+            if cluster is not None and gateways:
+                logger.info("No gateways assigned to this node; waiting")
+            else:
+                logger.info("No devices configured; waiting")
+        idle = not jobs
+        for job in set(live) - jobs:
+            del live[job]
+        for job in jobs - set(live):
+            live[job] = next(seq)
+            heappush(schedule, (now, job.interval, live[job], job))
+
+        # Queue every due job; entries of removed (or removed and re-added) jobs are dropped here
+        while schedule and schedule[0][0] <= now:
+            due, interval, entry_seq, job = heappop(schedule)
+            if live.get(job) != entry_seq:
+                continue
+            gateway_jobs = pending.setdefault(job.gateway, {})
+            gateway_jobs[job] = min(due, gateway_jobs.get(job, due))
+            # Stay on the interval grid unless a whole interval has been missed
+            next_due = due + interval if due + interval > now else now + interval
+            live[job] = next(seq)
+            heappush(schedule, (next_due, interval, live[job], job))
+
+        for gateway, future in list(running.items()):
+            if not future.done():
+                continue
+            del running[gateway]
+            try:
+                polled, duration, lag = future.result()
+            except Exception as e:
+                logger.error(f"Error polling gateway {gateway}: {str(e)}")
+                continue
+            poll_stats['runs'] += 1
+            poll_stats['gateways'][gateway] = {'devices': polled, 'duration': round(duration, 3), 'lag': round(lag, 3)}
+            poll_run_seconds.labels(gateway).observe(duration)
+            poll_lag_seconds.labels(gateway).observe(lag)
+            logger.debug(f"Polled {polled} devices on {gateway} in {duration:.2f}s ({lag:.2f}s behind schedule)")
+            if lag > FAST_POLL_INTERVAL:
+                logger.warning(f"Polling {gateway} is {lag:.2f}s behind schedule")
 
-threading.Thread(target=update_mqtt, daemon=True).start()
+        # A gateway runs one batch at a time; jobs that come due meanwhile wait for the next batch
+        for gateway in list(pending):
+            if gateway not in running:
+                running[gateway] = poll_executor.submit(poll_gateway, gateway, pending.pop(gateway))
+
+        next_due = schedule[0][0] if schedule else now + 1
+        sleep(min(max(0, next_due - monotonic()), 0.5))
+
+# The poller, MQTT client and pool reaper run once per process, however many HTTP workers serve the API
+background_started = False
+background_lock = threading.Lock()
+
+def start_background():
+    global background_started
+    with background_lock:
+        if background_started:
+            return
+        background_started = True
+    threading.Thread(target=connect_mqtt, daemon=True).start()
+    threading.Thread(target=replay_mqtt_outbox, daemon=True).start()
+    load_config()
+    threading.Thread(target=reap_modbus_pools, daemon=True).start()
+    threading.Thread(target=save_history, daemon=True).start()
+    if CONFIG_WATCH_INTERVAL > 0:
+        threading.Thread(target=watch_config, daemon=True).start()
+    if cluster is not None:
+        threading.Thread(target=cluster_heartbeat, daemon=True).start()
+    threading.Thread(target=update_mqtt, daemon=True).start()
+
+def serve():
+    start_background()
+    if SERVER_MODE == 'production':
+        # Worker threads share the snapshot, pools and breakers with the single poller
+        from waitress import serve as waitress_serve
+        # Every /stream client holds a thread for as long as it is connected, so they get their own
+        threads = HTTP_THREADS + STREAM_MAX_CLIENTS
+        logger.info(f"Serving with waitress on port {HTTP_PORT} using {threads} threads")
+        waitress_serve(app, host='0.0.0.0', port=HTTP_PORT, threads=threads, ident='solarmonitor')
+    else:
+        app.run(host='0.0.0.0', port=HTTP_PORT, debug=False, threaded=True)
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    serve()
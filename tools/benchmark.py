@@ -0,0 +1,194 @@
+"""End-to-end throughput benchmark against simulated gateways.
+
+Runs the add-on's poller and REST API in-process against tools/simulator.py
+gateways and its stub MQTT broker, then reports poll cycle time, Modbus reads
+per second, REST latency, memory footprint and MQTT message rate. Results are
+compared with the stored baseline; a regression beyond --tolerance exits 1.
+
+    python tools/benchmark.py                     # compare with the baseline
+    python tools/benchmark.py --update-baseline   # store this run as the baseline
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import threading
+from time import monotonic, sleep
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# Which direction is better for each reported metric (None is informational only)
+# and the smallest absolute change that counts, so run-to-run noise isn't a regression
+metric_directions = {
+    'cycle_time_ms': ('lower', 50),
+    'reads_per_sec': ('higher', 1),
+    'rest_p50_ms': ('lower', 1),
+    'rest_p99_ms': ('lower', 25),
+    'memory_mb': ('lower', 5),
+    'mqtt_messages_per_sec': (None, 0)
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def poll_totals(sm, registry):
+    # Sum and count of the poll run histogram over all gateways
+    total = count = 0
+    for gateway in sm.gateways:
+        total += registry.get_sample_value('conext_poll_run_seconds_sum', {'gateway': gateway}) or 0
+        count += registry.get_sample_value('conext_poll_run_seconds_count', {'gateway': gateway}) or 0
+    return total, count
+
+
+def run_rest_clients(sm, paths, clients, stop):
+    latencies = []
+    lock = threading.Lock()
+
+    def client():
+        test_client = sm.app.test_client()
+        while not stop.is_set():
+            path = random.choice(paths)
+            started = monotonic()
+            test_client.get(path)
+            elapsed = monotonic() - started
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    return threads, latencies
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run(args):
+    # The add-on reads its settings from the environment at import time, so
+    # they are set before the simulator imports it
+    config_path = os.path.join(tempfile.mkdtemp(), 'config.json')
+    broker_port = free_port()
+    os.environ.update(
+        CONFIG_PATH=config_path,
+        CONFIG_WATCH_INTERVAL='0',
+        MQTT_BROKER='127.0.0.1',
+        MQTT_PORT=str(broker_port),
+        MQTT_OUTBOX_PATH='',
+        HISTORY_DB='',
+        SCAN_CACHE='',
+        POLL_INTERVAL=str(args.poll_interval)
+    )
+    from simulator import Simulation, parse_devices
+    import solarmonitor as sm
+    from prometheus_client import REGISTRY
+
+    simulation = Simulation(args.gateways, parse_devices(args.devices), args.latency / 1000, args.jitter / 1000,
+                            args.loss, args.max_connections, broker_port=broker_port)
+    simulation.start()
+    with open(config_path, 'w') as f:
+        json.dump(simulation.gateway_configs(), f)
+
+    sm.start_background()
+    paths = [
+        f"/{gateway}/{device_type}/{instance}"
+        for gateway, gw_config in sm.gateways.items()
+        for device_type, devices in gw_config['device_ids'].items()
+        for instance in devices
+    ]
+    sleep(args.warmup)
+
+    requests_start = simulation.requests()
+    publishes_start = simulation.broker.publishes
+    poll_sum_start, poll_count_start = poll_totals(sm, REGISTRY)
+    stop = threading.Event()
+    threads, latencies = run_rest_clients(sm, paths, args.rest_clients, stop)
+    started = monotonic()
+    sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    duration = monotonic() - started
+    poll_sum, poll_count = poll_totals(sm, REGISTRY)
+    os.unlink(config_path)
+
+    runs = poll_count - poll_count_start
+    return {
+        'cycle_time_ms': round(1000 * (poll_sum - poll_sum_start) / runs, 2) if runs else None,
+        'reads_per_sec': round((simulation.requests() - requests_start) / duration, 1),
+        'rest_p50_ms': round(1000 * percentile(latencies, 0.5), 2),
+        'rest_p99_ms': round(1000 * percentile(latencies, 0.99), 2),
+        'rest_requests': len(latencies),
+        # ru_maxrss is in KiB on Linux
+        'memory_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'mqtt_messages_per_sec': round((simulation.broker.publishes - publishes_start) / duration, 1)
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for metric, (direction, noise) in metric_directions.items():
+        value, expected = results.get(metric), baseline.get(metric)
+        if direction is None or value is None or not expected or abs(value - expected) <= noise:
+            continue
+        change = (value - expected) / expected
+        if (direction == 'lower' and change > tolerance) or (direction == 'higher' and change < -tolerance):
+            regressions.append(f"{metric}: {value} vs baseline {expected} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the add-on against simulated gateways")
+    parser.add_argument('--gateways', type=int, default=3)
+    parser.add_argument('--devices', default='inverter=2,cc=4,battery=1,powermeter=1', help="devices per gateway")
+    parser.add_argument('--latency', type=float, default=10, help="gateway response latency in ms")
+    parser.add_argument('--jitter', type=float, default=5, help="latency jitter in ms")
+    parser.add_argument('--loss', type=float, default=0, help="fraction of requests left unanswered")
+    parser.add_argument('--max-connections', type=int, default=4, help="connections accepted per gateway")
+    parser.add_argument('--poll-interval', type=float, default=2)
+    parser.add_argument('--rest-clients', type=int, default=4)
+    parser.add_argument('--warmup', type=float, default=5, help="seconds before measuring")
+    parser.add_argument('--duration', type=float, default=20, help="seconds to measure")
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed fractional regression")
+    args = parser.parse_args()
+
+    scenario = {key: getattr(args, key) for key in
+                ('gateways', 'devices', 'latency', 'jitter', 'loss', 'max_connections', 'poll_interval', 'rest_clients')}
+    results = run(args)
+    print(json.dumps({'scenario': scenario, 'results': results}, indent=2))
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'scenario': scenario, 'results': results}, f, indent=2)
+            f.write('\n')
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare with; run with --update-baseline")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['scenario'] != scenario:
+        print("Scenario differs from the baseline's; not comparing")
+        return 0
+    regressions = compare(results, baseline['results'], args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""Run several add-on instances in cluster mode against simulated gateways.
+
+Starts tools/simulator.py (gateways and stub MQTT broker) and --nodes copies of
+solarmonitor.py sharing one config, then prints which node polls which
+gateway. With --kill-after, the first node is killed to show its gateways
+being reassigned to the survivors.
+
+    python tools/cluster.py --nodes 3 --gateways 6 --kill-after 20
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+from time import monotonic, sleep
+from urllib.request import urlopen
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON = os.path.join(TOOLS_DIR, '..', 'conext_api_multi', 'solarmonitor.py')
+
+
+def cluster_status(port):
+    try:
+        with urlopen(f"http://127.0.0.1:{port}/cluster", timeout=2) as response:
+            return json.load(response)
+    except (OSError, ValueError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run add-on instances in cluster mode against simulated gateways")
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--gateways', type=int, default=6)
+    parser.add_argument('--devices', default='inverter=1,cc=2,battery=1')
+    parser.add_argument('--gateway-port', type=int, default=5020, help="port of the first simulated gateway")
+    parser.add_argument('--broker-port', type=int, default=1883)
+    parser.add_argument('--http-port', type=int, default=5100, help="API port of the first node")
+    parser.add_argument('--heartbeat', type=float, default=2)
+    parser.add_argument('--lease', type=float, default=6)
+    parser.add_argument('--kill-after', type=float, help="seconds after which the first node is killed")
+    parser.add_argument('--duration', type=float, default=60)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    config_path = os.path.join(workdir, 'config.json')
+    processes = []
+    try:
+        simulator = subprocess.Popen([
+            sys.executable, os.path.join(TOOLS_DIR, 'simulator.py'), '--gateways', str(args.gateways),
+            '--devices', args.devices, '--port', str(args.gateway_port), '--broker-port', str(args.broker_port),
+            '--config', config_path
+        ], stdout=subprocess.DEVNULL)
+        processes.append(simulator)
+        while not os.path.exists(config_path):
+            sleep(0.1)
+
+        nodes = {}
+        for index in range(args.nodes):
+            node_id = f"node{index + 1}"
+            port = args.http_port + index
+            env = dict(os.environ,
+                       CLUSTER_NODE_ID=node_id,
+                       CLUSTER_URL=f"http://127.0.0.1:{port}",
+                       CLUSTER_HEARTBEAT=str(args.heartbeat),
+                       CLUSTER_LEASE=str(args.lease),
+                       CONFIG_PATH=config_path,
+                       DERIVED_PATH=os.path.join(workdir, 'derived.json'),
+                       HTTP_PORT=str(port),
+                       MQTT_BROKER='127.0.0.1',
+                       MQTT_PORT=str(args.broker_port),
+                       MQTT_OUTBOX_PATH='',
+                       HISTORY_DB='',
+                       SCAN_CACHE='',
+                       DERIVED_STATE='')
+            log = open(os.path.join(workdir, f"{node_id}.log"), 'w')
+            nodes[node_id] = (port, subprocess.Popen([sys.executable, ADDON], env=env, stdout=log, stderr=log))
+            processes.append(nodes[node_id][1])
+        print(f"Started {args.nodes} nodes; logs in {workdir}")
+
+        started = monotonic()
+        killed = False
+        while monotonic() - started < args.duration:
+            sleep(args.heartbeat)
+            if args.kill_after and not killed and monotonic() - started >= args.kill_after:
+                node_id, (_, process) = next(iter(nodes.items()))
+                process.send_signal(signal.SIGKILL)
+                del nodes[node_id]
+                killed = True
+                print(f"Killed {node_id}")
+            views = {node_id: cluster_status(port) for node_id, (port, _) in nodes.items()}
+            for node_id, view in views.items():
+                if view is None:
+                    print(f"{node_id}: not up yet")
+                    continue
+                owned = sorted(gateway for gateway, owner in view['gateways'].items() if owner == node_id)
+                print(f"{node_id}: members {view['members']} polls {owned}")
+            print()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    main()
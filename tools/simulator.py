@@ -0,0 +1,458 @@
+"""Local Conext gateway simulator and stub MQTT broker.
+
+Serves the register maps in solarmonitor.registers_data over Modbus TCP so the
+add-on can be run and benchmarked without hardware. Every simulated gateway
+listens on its own port; the generated gateway config is written to --config.
+
+    python tools/simulator.py --gateways 3 --devices inverter=2,cc=4,battery=1 --latency 20 --config /tmp/config.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import struct
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'conext_api_multi'))
+from solarmonitor import registers_data, register_decoders, int_formats, device_list_keys  # noqa: E402
+
+# Names reported at register 0, chosen so the add-on's device scan classifies them
+device_names = {
+    'battery': 'Battery Monitor',
+    'powermeter': 'PM',
+    'inverter': 'XW Pro',
+    'cc': 'MPPT 60',
+    'ags': 'AGS',
+    'scp': 'SCP',
+    'gridtie': 'CL 25'
+}
+
+# First unit ID of each device type
+unit_id_bases = {
+    'inverter': 10,
+    'cc': 30,
+    'scp': 40,
+    'ags': 50,
+    'gridtie': 60,
+    'powermeter': 80,
+    'battery': 190
+}
+
+# Plausible readings by unit
+nominal_values = {'V': 52, 'A': 20, 'W': 1500, 'Hz': 60, '°C': 25, '%': 80, 'kWh': 12}
+
+# Modbus exception codes
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_ADDRESS = 0x02
+TARGET_FAILED = 0x0B
+
+
+class SimulatedDevice:
+    """Holding registers of one device, filled from its registers_data map."""
+    def __init__(self, device_type, name):
+        self.device_type = device_type
+        self.registers = {}
+        self.specs = registers_data[device_type]
+        self.values = {}
+        for register_name, spec in self.specs.items():
+            if 'enum' in spec:
+                value = next(iter(spec['enum']))
+            else:
+                value = nominal_values.get(spec.get('unit'), 0)
+            self.values[register_name] = value
+            self.store(register_name)
+        name_bytes = name.encode('ascii')[:16].ljust(16, b'\x00')
+        for i, word in enumerate(struct.unpack('>8H', name_bytes)):
+            self.registers[i] = word
+
+    def store(self, register_name):
+        spec = self.specs[register_name]
+        length = spec['length']
+        if 'enum' in spec:
+            raw = self.values[register_name]
+        else:
+            raw = round((self.values[register_name] - spec.get('offset', 0)) / spec.get('scale', 1))
+        int_format = int_formats[length]
+        number = struct.Struct('>' + (int_format if spec.get('signed') else int_format.upper()))
+        bits = 16 * length
+        if spec.get('signed'):
+            raw = max(-(1 << (bits - 1)), min(raw, (1 << (bits - 1)) - 1))
+        else:
+            raw = max(0, min(raw, (1 << bits) - 1))
+        words = struct.unpack(f'>{length}H', number.pack(raw))
+        for i, word in enumerate(words):
+            self.registers[spec['register'] + i] = word
+
+    def drift(self, amount):
+        # Random walk of the numeric readings so deadbands and change detection get exercised
+        for register_name, spec in self.specs.items():
+            if 'enum' in spec or not self.values[register_name]:
+                continue
+            if spec.get('state_class') == 'total_increasing':
+                self.values[register_name] += abs(self.values[register_name]) * amount * random.random()
+            else:
+                self.values[register_name] *= 1 + random.uniform(-amount, amount)
+            self.store(register_name)
+
+    def read(self, start, count):
+        return [self.registers.get(address, 0) for address in range(start, start + count)]
+
+    def write(self, start, words):
+        for i, word in enumerate(words):
+            self.registers[start + i] = word
+        # Keep the drifting value in step with what was written
+        for register_name, spec in self.specs.items():
+            if start <= spec['register'] < start + len(words):
+                decoder = register_decoders[self.device_type][register_name]
+                raw_words = self.read(spec['register'], spec['length'])
+                if 'enum' in spec:
+                    self.values[register_name] = decoder.number.unpack(decoder.words.pack(*raw_words))[0]
+                else:
+                    self.values[register_name] = decoder.decode(raw_words)
+
+
+class GatewaySimulator:
+    """A Modbus TCP gateway with devices on several unit IDs.
+
+    Every request waits latency +/- jitter seconds before it is answered and is
+    dropped without a reply with probability loss. Connections beyond
+    max_connections are closed as soon as they are accepted.
+    """
+    def __init__(self, name, devices, latency=0.0, jitter=0.0, loss=0.0, max_connections=4, drift=0.005):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.max_connections = max_connections
+        self.drift_amount = drift
+        self.devices = {}  # unit_id -> SimulatedDevice
+        self.config_lists = {}  # device type -> [{'name', 'unit_id'}]
+        for device_type, device_count in devices.items():
+            for index in range(device_count):
+                unit_id = unit_id_bases[device_type] + index
+                device_name = f"{device_names[device_type]} {index + 1}"
+                self.devices[unit_id] = SimulatedDevice(device_type, device_name)
+                self.config_lists.setdefault(device_type, []).append({'name': f"{device_type}_{index + 1}", 'unit_id': unit_id})
+        self.connections = 0
+        self.requests = 0
+        self.dropped = 0
+        self.refused = 0
+        self.port = None
+        self._server = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._server = await asyncio.start_server(self.handle, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        asyncio.ensure_future(self._drift())
+        return self.port
+
+    async def _drift(self):
+        while True:
+            await asyncio.sleep(1)
+            for device in self.devices.values():
+                device.drift(self.drift_amount)
+
+    def respond(self, unit_id, pdu):
+        function = pdu[0]
+        if function not in (3, 6, 16):
+            return bytes([function | 0x80, ILLEGAL_FUNCTION])
+        device = self.devices.get(unit_id)
+        if device is None:
+            return bytes([function | 0x80, TARGET_FAILED])
+        if function == 6:
+            start, word = struct.unpack('>HH', pdu[1:5])
+            device.write(start, [word])
+            return pdu[:5]
+        start, count = struct.unpack('>HH', pdu[1:5])
+        if not 1 <= count <= 125 or start + count > 0x10000:
+            return bytes([function | 0x80, ILLEGAL_ADDRESS])
+        if function == 16:
+            device.write(start, struct.unpack(f'>{count}H', pdu[6:6 + 2 * count]))
+            return pdu[:5]
+        words = device.read(start, count)
+        return bytes([function, 2 * count]) + struct.pack(f'>{count}H', *words)
+
+    async def handle(self, reader, writer):
+        if self.connections >= self.max_connections:
+            self.refused += 1
+            writer.close()
+            return
+        self.connections += 1
+        try:
+            while True:
+                header = await reader.readexactly(7)
+                transaction_id, protocol_id, length, unit_id = struct.unpack('>HHHB', header)
+                pdu = await reader.readexactly(length - 1)
+                # Gateways answer one request at a time per connection
+                delay = self.latency + random.uniform(-self.jitter, self.jitter)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self.requests += 1
+                if random.random() < self.loss:
+                    self.dropped += 1
+                    continue
+                response = self.respond(unit_id, pdu)
+                writer.write(struct.pack('>HHHB', transaction_id, protocol_id, len(response) + 1, unit_id) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    def gateway_config(self, host='127.0.0.1'):
+        config = {'name': self.name, 'ip': host, 'port': self.port}
+        for device_type, devices in self.config_lists.items():
+            config[device_list_keys[device_type]] = devices
+        return config
+
+
+def decode_varint(buffer, position):
+    value = 0
+    for shift in range(0, 28, 7):
+        byte = buffer[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            break
+    return value, position
+
+
+def encode_varint(value):
+    encoded = bytearray()
+    while True:
+        byte, value = value & 0x7F, value >> 7
+        encoded.append(byte | (0x80 if value else 0))
+        if not value:
+            return bytes(encoded)
+
+
+def read_string(buffer, position):
+    length = struct.unpack('>H', buffer[position:position + 2])[0]
+    return buffer[position + 2:position + 2 + length], position + 2 + length
+
+
+def topic_matches(topic_filter, topic):
+    filter_parts, topic_parts = topic_filter.split('/'), topic.split('/')
+    for index, part in enumerate(filter_parts):
+        if part == '#':
+            return True
+        if index >= len(topic_parts) or (part != '+' and part != topic_parts[index]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+class StubBroker:
+    """Minimal MQTT 3.1.1/5 broker for local runs.
+
+    Counts every publish, keeps retained messages, forwards publishes to
+    subscribers at QoS 0 and sends a client's will when it drops without a
+    DISCONNECT. Enough for several add-on instances to coordinate in cluster mode.
+    """
+    def __init__(self):
+        self.publishes = 0
+        self.bytes = 0
+        self.topics = set()
+        self.retained = {}  # topic -> payload
+        self.port = None
+        self._server = None
+        self._clients = {}  # writer -> (version, [topic filters])
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._server = await asyncio.start_server(self.handle, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    @staticmethod
+    async def read_packet(reader):
+        first = (await reader.readexactly(1))[0]
+        length = 0
+        for shift in range(0, 28, 7):
+            byte = (await reader.readexactly(1))[0]
+            length |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+        return first >> 4, first & 0x0F, await reader.readexactly(length)
+
+    @staticmethod
+    def publish_packet(version, topic, payload, retain=False):
+        topic_bytes = topic.encode()
+        body = struct.pack('>H', len(topic_bytes)) + topic_bytes + (b'\x00' if version == 5 else b'') + payload
+        return bytes([0x30 | (1 if retain else 0)]) + encode_varint(len(body)) + body
+
+    def route(self, topic, payload, retain):
+        self.topics.add(topic)
+        self.publishes += 1
+        self.bytes += len(payload)
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        for writer, (version, filters) in list(self._clients.items()):
+            if any(topic_matches(topic_filter, topic) for topic_filter in filters):
+                writer.write(self.publish_packet(version, topic, payload))
+
+    def parse_connect(self, body):
+        _, position = read_string(body, 0)
+        version, flags = body[position], body[position + 1]
+        position += 4
+        if version == 5:
+            properties, position = decode_varint(body, position)
+            position += properties
+        _, position = read_string(body, position)  # client id
+        if not flags & 0x04:
+            return version, None
+        if version == 5:
+            properties, position = decode_varint(body, position)
+            position += properties
+        will_topic, position = read_string(body, position)
+        will_payload, position = read_string(body, position)
+        return version, (will_topic.decode('utf-8', 'replace'), will_payload, bool(flags & 0x20))
+
+    async def handle(self, reader, writer):
+        version = 4
+        will = None
+        try:
+            while True:
+                packet_type, flags, body = await self.read_packet(reader)
+                if packet_type == 1:  # CONNECT
+                    version, will = self.parse_connect(body)
+                    self._clients[writer] = (version, [])
+                    writer.write(b'\x20\x03\x00\x00\x00' if version == 5 else b'\x20\x02\x00\x00')
+                elif packet_type == 3:  # PUBLISH
+                    topic, position = read_string(body, 0)
+                    qos = (flags >> 1) & 0x03
+                    packet_id = body[position:position + 2] if qos else b''
+                    position += len(packet_id)
+                    if version == 5:
+                        properties, position = decode_varint(body, position)
+                        position += properties
+                    if qos:
+                        writer.write((b'\x40\x02' if qos == 1 else b'\x50\x02') + packet_id)
+                    self.route(topic.decode('utf-8', 'replace'), body[position:], bool(flags & 0x01))
+                elif packet_type == 6:  # PUBREL
+                    writer.write(b'\x70\x02' + body[:2])
+                elif packet_type == 8:  # SUBSCRIBE; grant QoS 0 to every filter
+                    packet_id = body[:2]
+                    position = 2
+                    if version == 5:
+                        properties, position = decode_varint(body, position)
+                        position += properties
+                    filters = []
+                    while position < len(body):
+                        topic_filter, position = read_string(body, position)
+                        filters.append(topic_filter.decode('utf-8', 'replace'))
+                        position += 1  # subscription options
+                    self._clients[writer][1].extend(filters)
+                    payload = packet_id + (b'\x00' if version == 5 else b'') + b'\x00' * len(filters)
+                    writer.write(bytes([0x90]) + encode_varint(len(payload)) + payload)
+                    for topic, retained_payload in list(self.retained.items()):
+                        if any(topic_matches(topic_filter, topic) for topic_filter in filters):
+                            writer.write(self.publish_packet(version, topic, retained_payload, retain=True))
+                elif packet_type == 12:  # PINGREQ
+                    writer.write(b'\xd0\x00')
+                elif packet_type == 14:  # DISCONNECT; a clean disconnect discards the will
+                    will = None
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._clients.pop(writer, None)
+            writer.close()
+            if will is not None:
+                self.route(*will)
+
+
+def parse_devices(spec):
+    """Parse 'inverter=2,cc=4' into {'inverter': 2, 'cc': 4}."""
+    devices = {}
+    for part in spec.split(','):
+        if part.strip():
+            device_type, device_count = part.split('=')
+            if device_type.strip() not in registers_data:
+                raise ValueError(f"Unknown device type {device_type}")
+            devices[device_type.strip()] = int(device_count)
+    return devices
+
+
+class Simulation:
+    """Gateways and a broker running on an event loop in a background thread.
+
+    Port 0 picks a free port; broker_port None runs without a broker.
+    """
+    def __init__(self, gateways, devices, latency=0.0, jitter=0.0, loss=0.0, max_connections=4, base_port=0, broker_port=0):
+        self.gateways = [
+            GatewaySimulator(f"SIM_{index + 1}", devices, latency, jitter, loss, max_connections)
+            for index in range(gateways)
+        ]
+        self.broker = StubBroker()
+        self.base_port = base_port
+        self.broker_port = broker_port
+        self.loop = asyncio.new_event_loop()
+        self._thread = None
+
+    async def _start(self):
+        for index, gateway in enumerate(self.gateways):
+            await gateway.start(port=self.base_port + index if self.base_port else 0)
+        if self.broker_port is not None:
+            await self.broker.start(port=self.broker_port)
+
+    def start(self):
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self._start())
+            started.set()
+            self.loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def requests(self):
+        return sum(gateway.requests for gateway in self.gateways)
+
+    def gateway_configs(self):
+        return [gateway.gateway_config() for gateway in self.gateways]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate Conext gateways and an MQTT broker")
+    parser.add_argument('--gateways', type=int, default=1)
+    parser.add_argument('--devices', default='inverter=2,cc=4,battery=1,powermeter=1', help="devices per gateway, e.g. inverter=2,cc=4")
+    parser.add_argument('--latency', type=float, default=10, help="response latency in ms")
+    parser.add_argument('--jitter', type=float, default=5, help="latency jitter in ms")
+    parser.add_argument('--loss', type=float, default=0, help="fraction of requests left unanswered")
+    parser.add_argument('--max-connections', type=int, default=4, help="connections accepted per gateway")
+    parser.add_argument('--port', type=int, default=5020, help="port of the first gateway; the rest follow")
+    parser.add_argument('--broker-port', type=int, default=1883, help="stub MQTT broker port")
+    parser.add_argument('--no-broker', action='store_true', help="don't run the stub MQTT broker")
+    parser.add_argument('--config', help="write the gateway config for the add-on to this file")
+    args = parser.parse_args()
+
+    simulation = Simulation(args.gateways, parse_devices(args.devices), args.latency / 1000, args.jitter / 1000,
+                            args.loss, args.max_connections, args.port, None if args.no_broker else args.broker_port)
+    simulation.start()
+    config = simulation.gateway_configs()
+    if args.config:
+        with open(args.config, 'w') as f:
+            json.dump(config, f, indent=2)
+    for gateway in simulation.gateways:
+        print(f"{gateway.name} listening on port {gateway.port} with {len(gateway.devices)} devices")
+    if not args.no_broker:
+        print(f"Stub MQTT broker listening on port {simulation.broker.port}")
+    try:
+        while True:
+            threading.Event().wait(10)
+            print(f"{simulation.requests()} requests served, {simulation.broker.publishes} MQTT messages received")
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()